@@ -0,0 +1,444 @@
+"""转换和引用更新的性能基准
+
+用法:
+    python benchmark.py generate DIR --images 200 --posts 50
+    python benchmark.py run --corpus DIR -o results.json
+    python benchmark.py compare baseline.json results.json --threshold 0.1
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from colorama import Fore, Style, init
+from PIL import Image, ImageDraw
+
+import main as assistant
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# ((宽, 高), 格式, 内容类型, 权重)，按权重随机选择
+IMAGE_SHAPES = [
+    ((640, 480), ".jpg", "photo", 4),
+    ((1600, 1067), ".jpg", "photo", 3),
+    ((3000, 2000), ".jpg", "photo", 1),
+    ((1280, 800), ".png", "screenshot", 3),
+    ((400, 400), ".png", "flat", 2),
+    ((800, 600), ".bmp", "photo", 1),
+]
+
+LOREM = (
+    "静态博客的图片占据了大部分流量，转换为 webp 之后页面加载明显变快。"
+    "The quick brown fox jumps over the lazy dog. "
+    "这一段只是为了让文章有接近真实的长度和引用密度。"
+)
+
+
+def draw_image(size, kind, rng):
+    """生成指定类型的合成图片，不依赖 numpy
+    Args:
+        size: (宽, 高)
+        kind: "photo" 噪点渐变、"screenshot" 文字和色块、"flat" 少量纯色块
+        rng: random.Random
+    """
+    width, height = size
+    if kind == "photo":
+        bands = []
+        for _ in range(3):
+            gradient = Image.linear_gradient("L").rotate(rng.randrange(360))
+            noise = Image.effect_noise((256, 256), rng.uniform(20, 60))
+            bands.append(Image.blend(gradient, noise, 0.4).resize(size))
+        return Image.merge("RGB", bands)
+
+    image = Image.new("RGB", size, (250, 250, 250))
+    draw = ImageDraw.Draw(image)
+    blocks = 6 if kind == "flat" else 30
+    for _ in range(blocks):
+        x0, y0 = rng.randrange(width), rng.randrange(height)
+        x1, y1 = x0 + rng.randrange(20, width // 2), y0 + rng.randrange(20, height // 2)
+        color = tuple(rng.randrange(256) for _ in range(3))
+        draw.rectangle((x0, y0, x1, y1), fill=color)
+    if kind == "screenshot":
+        for y in range(10, height, 18):
+            draw.text((10, y), LOREM[: rng.randrange(20, 60)], fill=(30, 30, 30))
+    return image
+
+
+def reference_line(ref_type, path, rng):
+    """生成一行指定类型的图片引用"""
+    alt = f"图{rng.randrange(1000)}"
+    if ref_type == "markdown":
+        return f"![{alt}]({path})"
+    if ref_type == "html":
+        return f'<img src="{path}" alt="{alt}" width="800">'
+    if ref_type == "shortcode":
+        return f'{{{{< imgrow src="{path}" alt="{alt}" >}}}}'
+    return f"原图在这里： {path}"
+
+
+def generate_corpus(corpus_dir, images=200, posts=50, refs_per_post=6, seed=42):
+    """生成合成站点：content/post/<slug>/index.md 页面包和 static/images 共享图片
+    Args:
+        corpus_dir: 输出目录，必须不存在或为空
+        images: 图片数量，约五分之一放在 static/images
+        posts: 文章数量
+        refs_per_post: 每篇文章平均的图片引用数
+        seed: 随机种子，相同参数生成的语料完全相同
+    Returns:
+        summary: 包含 images、posts、bytes 的字典
+    """
+    rng = random.Random(seed)
+    static_dir = os.path.join(corpus_dir, "static", "images")
+    os.makedirs(static_dir, exist_ok=True)
+    post_dirs = []
+    for index in range(posts):
+        post_dir = os.path.join(corpus_dir, "content", "post", f"post-{index:04d}")
+        os.makedirs(post_dir, exist_ok=True)
+        post_dirs.append(post_dir)
+
+    weights = [shape[3] for shape in IMAGE_SHAPES]
+    shared_images = []
+    bundle_images = {post_dir: [] for post_dir in post_dirs}
+    total_bytes = 0
+    for index in range(images):
+        size, ext, kind, _ = rng.choices(IMAGE_SHAPES, weights)[0]
+        name = f"img-{index:05d}{ext}"
+        if rng.random() < 0.2 or not post_dirs:
+            image_path = os.path.join(static_dir, name)
+            shared_images.append(f"/images/{name}")
+        else:
+            post_dir = rng.choice(post_dirs)
+            image_path = os.path.join(post_dir, name)
+            bundle_images[post_dir].append(name)
+        save_options = {"quality": 90} if ext == ".jpg" else {}
+        draw_image(size, kind, rng).save(image_path, **save_options)
+        total_bytes += os.path.getsize(image_path)
+
+    ref_types = ["markdown", "markdown", "html", "shortcode", "direct"]
+    for index, post_dir in enumerate(post_dirs):
+        candidates = bundle_images[post_dir] + shared_images
+        lines = ["---", f"title: 文章 {index}"]
+        if candidates:
+            lines.append(f"image: {rng.choice(candidates)}")
+        lines += ["---", ""]
+        for _ in range(max(1, round(rng.gauss(refs_per_post, 2)))):
+            lines.append(LOREM * rng.randrange(1, 4))
+            lines.append("")
+            if candidates:
+                path = rng.choice(candidates)
+                lines.append(reference_line(rng.choice(ref_types), path, rng))
+                lines.append("")
+        with open(os.path.join(post_dir, "index.md"), "w", encoding="utf-8") as f:
+            f.write("\n".join(lines))
+
+    return {"images": images, "posts": posts, "bytes": total_bytes}
+
+
+def convert_corpus(folder_path, lossless=False, workers=None):
+    return assistant.convert_images(
+        folder_path,
+        lossless=lossless,
+        quality=80,
+        overwrite="always",
+        workers=workers,
+        incremental=False,
+        deduplicate=False,
+    )
+
+
+def measure_discovery(folder_path):
+    scan = assistant.SiteScan(folder_path)
+    assistant.WebpIndex(folder_path, scan=scan)
+    return len(scan.entries)
+
+
+def measure_rewrite(folder_path):
+    assistant.rewrite_references(folder_path, replace_direct=True)
+    return len(assistant.find_markdown_files(folder_path))
+
+
+def prepare_delete(folder_path):
+    """转换并更新引用，原图不再被引用时才能全部删除"""
+    convert_corpus(folder_path)
+    assistant.rewrite_references(folder_path, replace_direct=True)
+
+
+def measure_delete(folder_path):
+    expected = len(assistant.find_image_files(folder_path))
+    deleted = assistant.delete_original_images(folder_path, backup=False)
+    if deleted != expected:
+        raise RuntimeError(f"只删除了 {deleted}/{expected} 张原图")
+    return deleted
+
+
+def source_bytes(folder_path):
+    return sum(
+        os.path.getsize(path) for path in assistant.find_image_files(folder_path)
+    )
+
+
+# 名称: (准备阶段, 计时阶段, 计数单位)；准备阶段在父进程执行，不计入耗时和内存
+CASES = {
+    "discovery": (None, measure_discovery, "files"),
+    "convert-serial-lossy": (
+        None,
+        lambda folder: convert_corpus(folder, workers=1)["converted"],
+        "images",
+    ),
+    "convert-parallel-lossy": (
+        None,
+        lambda folder: convert_corpus(folder)["converted"],
+        "images",
+    ),
+    "convert-serial-lossless": (
+        None,
+        lambda folder: convert_corpus(folder, lossless=True, workers=1)["converted"],
+        "images",
+    ),
+    "convert-parallel-lossless": (
+        None,
+        lambda folder: convert_corpus(folder, lossless=True)["converted"],
+        "images",
+    ),
+    "rewrite": (convert_corpus, measure_rewrite, "posts"),
+    "delete": (prepare_delete, measure_delete, "images"),
+}
+
+
+def peak_rss_mb():
+    """当前进程及其已结束子进程中最大的常驻内存（MB）"""
+    if resource is None:
+        return None
+    peak = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    # Linux 单位是 KB，macOS 是字节
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def run_case_in_child(name, folder_path, result_path):
+    """在子进程中执行一次计时阶段，结果写入 result_path，避免各用例的内存互相影响"""
+    _, measure, _ = CASES[name]
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        start = time.perf_counter()
+        count = measure(folder_path)
+        elapsed = time.perf_counter() - start
+    with open(result_path, "w", encoding="utf-8") as f:
+        json.dump({"elapsed": elapsed, "count": count, "peak_rss_mb": peak_rss_mb()}, f)
+
+
+def run_case(name, corpus_dir, repeat=3):
+    """在语料副本上重复执行一个用例，取耗时的中位数
+    Returns:
+        result: 包含 elapsed、count、rate、mb_per_sec、peak_rss_mb 等的字典
+    """
+    prepare, _, unit = CASES[name]
+    runs = []
+    for _ in range(repeat):
+        with tempfile.TemporaryDirectory(prefix="webp-bench-") as work_dir:
+            folder_path = os.path.join(work_dir, "site")
+            shutil.copytree(corpus_dir, folder_path)
+            if prepare:
+                with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(
+                    devnull
+                ):
+                    prepare(folder_path)
+            size = source_bytes(folder_path)
+            result_path = os.path.join(work_dir, "result.json")
+            subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "_case", name]
+                + [folder_path, result_path],
+                check=True,
+            )
+            with open(result_path, "r", encoding="utf-8") as f:
+                runs.append(dict(json.load(f), bytes=size))
+
+    runs.sort(key=lambda run: run["elapsed"])
+    median = runs[len(runs) // 2]
+    elapsed = median["elapsed"]
+    rss = [run["peak_rss_mb"] for run in runs if run["peak_rss_mb"] is not None]
+    return {
+        "unit": unit,
+        "count": median["count"],
+        "elapsed": elapsed,
+        "runs": [run["elapsed"] for run in runs],
+        "rate": median["count"] / elapsed if elapsed else None,
+        "mb_per_sec": (
+            median["bytes"] / 1024 / 1024 / elapsed
+            if name.startswith("convert") and elapsed
+            else None
+        ),
+        "peak_rss_mb": max(rss) if rss else None,
+    }
+
+
+def run_benchmarks(corpus_dir, cases=None, repeat=3):
+    """执行所有用例
+    Returns:
+        report: 包含环境信息和各用例结果的字典
+    """
+    report = {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "version": assistant.VERSION,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "encoder": assistant.EncodeCache.encoder_version(),
+        "corpus": {
+            "path": os.path.abspath(corpus_dir),
+            "images": len(assistant.find_image_files(corpus_dir)),
+            "posts": len(assistant.find_markdown_files(corpus_dir)),
+            "bytes": source_bytes(corpus_dir),
+        },
+        "results": {},
+    }
+    for name in cases or CASES:
+        print(f"运行 {name} ...", end="", flush=True)
+        result = run_case(name, corpus_dir, repeat)
+        report["results"][name] = result
+        print(f" {format_result(result)}")
+    return report
+
+
+def format_result(result):
+    text = f"{result['elapsed']:.2f} 秒，{result['rate']:.1f} {result['unit']}/秒"
+    if result["mb_per_sec"] is not None:
+        text += f"，{result['mb_per_sec']:.1f} MB/秒"
+    if result["peak_rss_mb"] is not None:
+        text += f"，峰值内存 {result['peak_rss_mb']:.0f} MB"
+    return text
+
+
+def compare_reports(baseline, current, threshold=0.1):
+    """对比两次结果，吞吐量下降或峰值内存上升超过 threshold 视为退化
+    Returns:
+        regressions: [(用例, 指标, 基准值, 当前值, 变化比例)]
+    """
+    regressions = []
+    for name, result in current["results"].items():
+        base = baseline["results"].get(name)
+        if not base:
+            continue
+        print(f"\n{name}")
+        for metric, higher_is_better in (
+            ("rate", True),
+            ("mb_per_sec", True),
+            ("peak_rss_mb", False),
+        ):
+            old, new = base.get(metric), result.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            regressed = -change > threshold if higher_is_better else change > threshold
+            color = Fore.RED if regressed else Fore.GREEN
+            print(
+                f"  {metric}: {old:.2f} -> {new:.2f} "
+                f"{color}({change:+.1%}){Style.RESET_ALL}"
+            )
+            if regressed:
+                regressions.append((name, metric, old, new, change))
+    return regressions
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Blog-Webp-Assistant 性能基准")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    generate_parser = subparsers.add_parser("generate", help="生成合成语料")
+    generate_parser.add_argument("corpus", help="输出目录")
+    generate_parser.add_argument("--images", type=int, default=200)
+    generate_parser.add_argument("--posts", type=int, default=50)
+    generate_parser.add_argument(
+        "--refs-per-post", type=int, default=6, help="每篇文章平均的图片引用数"
+    )
+    generate_parser.add_argument("--seed", type=int, default=42)
+
+    run_parser = subparsers.add_parser("run", help="执行基准测试")
+    run_parser.add_argument(
+        "--corpus", help="语料目录，默认按 --images/--posts 临时生成"
+    )
+    run_parser.add_argument("--images", type=int, default=200)
+    run_parser.add_argument("--posts", type=int, default=50)
+    run_parser.add_argument("--seed", type=int, default=42)
+    run_parser.add_argument(
+        "--cases", nargs="+", choices=list(CASES), help="只运行这些用例"
+    )
+    run_parser.add_argument("--repeat", type=int, default=3, help="每个用例的重复次数")
+    run_parser.add_argument("-o", "--output", help="结果 JSON 的保存路径")
+
+    compare_parser = subparsers.add_parser("compare", help="对比两次结果并标出退化")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument(
+        "--threshold", type=float, default=0.1, help="视为退化的变化比例（默认 0.1）"
+    )
+
+    case_parser = subparsers.add_parser("_case")
+    case_parser.add_argument("name", choices=list(CASES))
+    case_parser.add_argument("folder")
+    case_parser.add_argument("result")
+    return parser
+
+
+def main(argv=None):
+    init()
+    args = build_parser().parse_args(argv)
+
+    if args.command == "_case":
+        run_case_in_child(args.name, args.folder, args.result)
+        return 0
+
+    if args.command == "generate":
+        summary = generate_corpus(
+            args.corpus, args.images, args.posts, args.refs_per_post, args.seed
+        )
+        print(
+            f"已生成 {summary['images']} 张图片、{summary['posts']} 篇文章"
+            f"（{summary['bytes'] / 1024 / 1024:.1f} MB）"
+        )
+        return 0
+
+    if args.command == "compare":
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        with open(args.current, "r", encoding="utf-8") as f:
+            current = json.load(f)
+        regressions = compare_reports(baseline, current, args.threshold)
+        if regressions:
+            print(f"\n{Fore.RED}{len(regressions)} 项指标退化{Style.RESET_ALL}")
+            return 1
+        print(f"\n{Fore.GREEN}没有发现退化{Style.RESET_ALL}")
+        return 0
+
+    with tempfile.TemporaryDirectory(prefix="webp-corpus-") as tmp_dir:
+        corpus_dir = args.corpus
+        if corpus_dir is None:
+            corpus_dir = os.path.join(tmp_dir, "site")
+            generate_corpus(corpus_dir, args.images, args.posts, seed=args.seed)
+        report = run_benchmarks(corpus_dir, args.cases, args.repeat)
+
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output)
+        print(f"\n结果已保存到 {args.output}")
+    else:
+        print(output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,11 +1,54 @@
+import argparse
+import asyncio
+import cProfile
+import csv
+import ctypes
+import ctypes.util
+import fnmatch
+import hashlib
+import io
+import json
 import os
+import pstats
 import re
+import select
 import shutil
+import struct
+import sys
+import threading
+import time
+import tracemalloc
+from collections import deque, namedtuple
+from contextlib import contextmanager
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime
 
 import yaml
 from colorama import Fore, Style, init
-from PIL import Image
+import PIL
+from PIL import Image, ImageOps, features
+
+try:
+    import numpy as np
+except ImportError:
+    # 只有按相似度搜索质量等功能需要 numpy
+    np = None
+
+try:
+    import fcntl
+
+    # Linux 上用于 reflink 的 ioctl，其他平台退回普通复制
+    FICLONE = 0x40049409 if sys.platform.startswith("linux") else None
+except ImportError:
+    fcntl = None
+    FICLONE = None
 
 # 初始化colorama
 init()
@@ -13,29 +56,245 @@ init()
 VERSION = "0.1-Beta"
 AUTHOR = "安和（AHCorn）"
 PROJECT_URL = "https://github.com/AHCorn/Blog-Webp-Assistant"
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".tiff", ".gif")
+MARKDOWN_EXTENSIONS = (".md", ".markdown")
+MANIFEST_NAME = ".webp-manifest.jsonl"
+SNAPSHOT_MANIFEST_NAME = ".snapshot.json"
+REFERENCE_INDEX_NAME = ".webp-references.json"
+JOURNAL_NAME = ".webp-journal.jsonl"
+# 删除原图时每批提交的文件数
+DELETE_BATCH_SIZE = 256
+# 会写运行日志、可以用 --resume 继续的命令
+RESUMABLE_COMMANDS = ("convert", "rewrite-references", "pipeline")
+# temp_path 生成的临时文件名：原文件名.tmp-进程号-线程号
+TEMP_FILE_PATTERN = re.compile(r"\.tmp-(\d+)-\d+$")
+DEFAULT_CACHE_SIZE_MB = 2048
+# 编码流程改变输出时加一，使旧的缓存条目失效
+# 2: 编码前应用 EXIF 方向；3: 去除元数据时 avif 不再带上原图的 ICC
+ENCODER_PIPELINE_VERSION = 3
+DEFAULT_QUEUE_SIZE = 8
+# Pillow 没有暴露 libwebp 的 near_lossless，用高质量有损编码代替
+NEAR_LOSSLESS_QUALITY = 95
+# 多格式转换的候选格式：按参数编码的webp、无损webp、avif
+OUTPUT_FORMATS = ("webp", "webp-lossless", "avif")
+FORMAT_NAMES = {"webp": "webp", "webp-lossless": "无损 webp", "avif": "AVIF"}
+KEEP_POLICIES = ("smallest", "all")
+# 同样的数值下 avif 的画质明显更高，默认用 webp 质量减去该值，两者画质大致相当
+AVIF_QUALITY_OFFSET = 20
+# --quality 的默认值；webp 无损编码时 avif 仍按它推算质量
+DEFAULT_QUALITY = 80
+# 转换结果的扩展名，同名时引用优先指向webp
+OUTPUT_EXTENSIONS = (".webp", ".avif")
+# strip 去除所有元数据，icc 只保留色彩配置文件，all 保留 ICC、EXIF 和 XMP
+METADATA_POLICIES = ("strip", "icc", "all")
+CONTENT_CLASS_NAMES = {"lossless": "无损", "near_lossless": "近无损", "lossy": "有损"}
+# 响应式图片的命名规则：name-480w.webp
+RESPONSIVE_PATTERN = re.compile(r"^(.*)-(\d+)w\.webp$", re.IGNORECASE)
+# Hugo 的生成目录和依赖目录，里面的图片不是源文件；
+# 以 / 开头的只匹配站点根目录下的路径，content 中同名的页面包不受影响
+DEFAULT_EXCLUDES = ("/public", "/resources", "node_modules", ".git")
 # 球球先手动备份，弄坏了不要骂我
 
 
-def create_backup(folder_path):
+def get_backup_dir():
+    """备份根目录，位于脚本所在目录下"""
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    backup_dir = os.path.join(script_dir, "backup")
+    os.makedirs(backup_dir, exist_ok=True)
+    return backup_dir
+
+
+def get_log_dir():
+    """运行日志目录，位于脚本所在目录下"""
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    log_dir = os.path.join(script_dir, "logs")
+    os.makedirs(log_dir, exist_ok=True)
+    return log_dir
+
+
+def default_log_path(prefix="run"):
+    """logs 目录下按时间命名的日志文件路径"""
+    return os.path.join(
+        get_log_dir(), f"{prefix}-{datetime.now().strftime('%Y%m%d_%H%M%S')}.log"
+    )
+
+
+def temp_path(path):
+    """同目录下的临时文件名，写完后用 os.replace 替换到 path，见 TEMP_FILE_PATTERN"""
+    return f"{path}.tmp-{os.getpid()}-{threading.get_ident()}"
+
+
+def clone_file(src, dst):
+    """复制文件，文件系统支持时使用 reflink（写时复制），否则普通复制"""
+    if FICLONE is not None:
+        try:
+            with open(src, "rb") as src_file, open(dst, "wb") as dst_file:
+                fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+            shutil.copystat(src, dst)
+            return
+        except OSError:
+            pass
+    shutil.copy2(src, dst)
+
+
+def load_snapshot_manifest(snapshot_path):
+    """读取快照清单，不是快照或清单损坏时返回None"""
+    try:
+        with open(
+            os.path.join(snapshot_path, SNAPSHOT_MANIFEST_NAME), "r", encoding="utf-8"
+        ) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def find_previous_snapshot(backup_dir, folder_path, prefix="backup"):
+    """找到同一文件夹、同一前缀最近一次的快照
+
+    只比较同一前缀的快照：删除原图前的快照只包含少数文件，不能作为下一次完整备份的基础
+    Returns:
+        (快照路径, 快照清单)，没有时返回 (None, None)
+    """
+    source = os.path.abspath(folder_path)
+    try:
+        names = os.listdir(backup_dir)
+    except OSError:
+        return None, None
+
+    pattern = re.compile(re.escape(prefix) + r"_(\d{8}_\d{6})(?:_(\d+))?")
+
+    def created_key(match):
+        return (match.group(1), int(match.group(2) or 0))
+
+    matches = filter(None, map(pattern.fullmatch, names))
+    for match in sorted(matches, key=created_key, reverse=True):
+        name = match.group(0)
+        snapshot_path = os.path.join(backup_dir, name)
+        manifest = load_snapshot_manifest(snapshot_path)
+        if manifest and manifest.get("source") == source:
+            return snapshot_path, manifest
+    return None, None
+
+
+def create_snapshot(folder_path, files, prefix="backup", stat=os.stat):
+    """创建增量快照
+
+    与上一次快照相比未变化的文件直接硬链接到上一次快照中的副本，
+    其余文件通过 reflink 或复制保存，并写入清单以便恢复。
+    Args:
+        folder_path: 被备份的文件夹路径
+        files: 要备份的文件列表
+        prefix: 快照文件夹名前缀
+        stat: 获取文件 stat 的函数，可传入 SiteScan.stat 复用扫描结果
+    Returns:
+        backup_path: 快照文件夹路径
+    """
+    backup_dir = get_backup_dir()
+    previous_path, previous_manifest = find_previous_snapshot(
+        backup_dir, folder_path, prefix
+    )
+    previous_files = previous_manifest["files"] if previous_manifest else {}
+
+    # 使用时间戳创建唯一的备份文件夹
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    backup_path = os.path.join(backup_dir, f"{prefix}_{timestamp}")
+    suffix = 1
+    while os.path.exists(backup_path):
+        suffix += 1
+        backup_path = os.path.join(backup_dir, f"{prefix}_{timestamp}_{suffix}")
+    os.makedirs(backup_path)
+
+    manifest_files = {}
+    linked_count = 0
+    copied_count = 0
+    copied_bytes = 0
+    for file_path in files:
+        rel_path = os.path.relpath(file_path, folder_path).replace(os.sep, "/")
+        backup_file_path = os.path.join(backup_path, rel_path)
+        os.makedirs(os.path.dirname(backup_file_path), exist_ok=True)
+
+        file_stat = stat(file_path)
+        entry = {"size": file_stat.st_size, "mtime_ns": file_stat.st_mtime_ns}
+        manifest_files[rel_path] = entry
+
+        # 文件未变化时硬链接到上一次快照，快照中的文件不会再被修改
+        previous = previous_files.get(rel_path)
+        if previous == entry:
+            try:
+                os.link(os.path.join(previous_path, rel_path), backup_file_path)
+                linked_count += 1
+                continue
+            except OSError:
+                pass
+        clone_file(file_path, backup_file_path)
+        copied_count += 1
+        copied_bytes += file_stat.st_size
+
+    # 清单最后写入，中断时留下的快照没有清单，不会被当作有效快照
+    write_atomic(
+        os.path.join(backup_path, SNAPSHOT_MANIFEST_NAME),
+        json.dumps(
+            {
+                "source": os.path.abspath(folder_path),
+                "created": timestamp,
+                "files": manifest_files,
+            },
+            ensure_ascii=False,
+        ),
+    )
+
+    print(
+        f"快照包含 {len(manifest_files)} 个文件：复用上次快照 {linked_count} 个，"
+        f"新复制 {copied_count} 个（{copied_bytes / 1024 / 1024:.1f} MB）"
+    )
+    return backup_path
+
+
+def restore_snapshot(snapshot_path, folder_path=None):
+    """从快照恢复文件
+    Args:
+        snapshot_path: 快照文件夹路径
+        folder_path: 恢复到的文件夹，默认为快照记录的原始文件夹
+    Returns:
+        restored_count: 恢复的文件数量，失败时返回None
+    """
+    manifest = load_snapshot_manifest(snapshot_path)
+    if not manifest:
+        print(f"{Fore.RED}{snapshot_path} 不是有效的快照{Style.RESET_ALL}")
+        return None
+    folder_path = folder_path or manifest["source"]
+
+    restored_count = 0
+    for rel_path in manifest["files"]:
+        target_path = os.path.join(folder_path, rel_path)
+        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+        # 复制到临时文件再替换，不能让恢复出的文件与快照共用同一份数据，
+        # 中断时目标文件也不会缺失或只写了一半
+        tmp_path = temp_path(target_path)
+        clone_file(os.path.join(snapshot_path, rel_path), tmp_path)
+        os.replace(tmp_path, target_path)
+        restored_count += 1
+    print(
+        f"\n{Fore.GREEN}已从 {snapshot_path} 恢复 {restored_count} 个文件{Style.RESET_ALL}"
+    )
+    return restored_count
+
+
+def create_backup(folder_path, scan=None):
     """创建备份
     Args:
         folder_path: 要备份的文件夹路径
+        scan: 已完成的 SiteScan，默认重新扫描
     Returns:
         backup_path: 备份文件夹路径
     """
     try:
-        # 创建backup文件夹
-        script_dir = os.path.dirname(os.path.abspath(__file__))
-        backup_dir = os.path.join(script_dir, "backup")
-        if not os.path.exists(backup_dir):
-            os.makedirs(backup_dir)
-
-        # 使用时间戳创建唯一的备份文件夹
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        backup_path = os.path.join(backup_dir, f"backup_{timestamp}")
-
-        # 复制文件夹内容
-        shutil.copytree(folder_path, backup_path)
+        # 只备份脚本会修改的图片、webp和Markdown文件
+        if scan is None:
+            scan = SiteScan(folder_path)
+        backup_path = create_snapshot(
+            folder_path, list(scan.entries), prefix="backup", stat=scan.stat
+        )
         print(f"\n{Fore.GREEN}备份已创建: {backup_path}{Style.RESET_ALL}")
         return backup_path
     except Exception as e:
@@ -43,44 +302,268 @@ def create_backup(folder_path):
         return None
 
 
-def delete_original_images(folder_path):
-    """删除已转换为webp的原始图片
+def check_output_container(path):
+    """检查转换结果的容器结构是否完整，不解码图像数据
+    Returns:
+        reason: 不完整或无效的原因，完整时返回None
+    """
+    size = os.path.getsize(path)
+    if size == 0:
+        return "文件为空"
+    with open(path, "rb") as f:
+        if path.lower().endswith(".avif"):
+            # ISO BMFF：以 ftyp 开头的一串 box，box 大小之和应等于文件大小
+            offset = 0
+            while offset < size:
+                f.seek(offset)
+                header = f.read(8)
+                if len(header) < 8:
+                    return f"avif 文件不完整（{size} 字节处截断）"
+                box_size, box_type = struct.unpack(">I4s", header)
+                if offset == 0 and box_type != b"ftyp":
+                    return "不是有效的 avif 文件"
+                if box_size == 1:
+                    box_size = struct.unpack(">Q", f.read(8))[0]
+                elif box_size == 0:
+                    box_size = size - offset
+                if box_size < 8:
+                    return "不是有效的 avif 文件"
+                offset += box_size
+            if offset != size:
+                return f"avif 文件不完整（应为 {offset} 字节，实际 {size} 字节）"
+            return None
+        header = f.read(12)
+    if len(header) < 12 or header[:4] != b"RIFF" or header[8:] != b"WEBP":
+        return "不是有效的webp文件"
+    riff_size = struct.unpack("<I", header[4:8])[0] + 8
+    if riff_size != size:
+        return f"webp 文件不完整（应为 {riff_size} 字节，实际 {size} 字节）"
+    return None
+
+
+def verify_webp(job):
+    """校验转换结果是否完整、与原图一致，确认后原图才可以删除，异常不会抛出到主进程
+
+    转换结果通常是webp，多格式转换时也可能是 avif。
+    依次检查容器结构（见 check_output_container）、尺寸和宽高比（允许按 EXIF 方向旋转和等比缩小）、
+    动图帧数，再完整解码一遍；指定 max_diff 时还用 pixel_difference 与原图比较。
+    Args:
+        job: (原图路径, 输出路径, 允许的最大像素差异或None)
+    Returns:
+        result: 包含 path、webp、ok、reason（未通过的原因）和 difference 的字典
+    """
+    image_path, webp_path, max_diff = job
+    result = {
+        "path": image_path,
+        "webp": webp_path,
+        "ok": False,
+        "reason": None,
+        "difference": None,
+    }
+    try:
+        result["reason"] = check_output_container(webp_path)
+        if result["reason"]:
+            return result
+
+        with Image.open(image_path) as source, Image.open(webp_path) as webp:
+            width, height = source.size
+            # 按 EXIF 方向旋转过的输出宽高互换，旧版本生成的未旋转输出也认可
+            expected = [(width, height)]
+            if source.getexif().get(0x0112) in (5, 6, 7, 8):
+                expected.append((height, width))
+            if not any(
+                webp.width <= w and webp.height <= h
+                # 缩小时两边各有最多 1 像素的取整误差
+                and abs(webp.width * h - webp.height * w) <= w + h
+                for w, h in expected
+            ):
+                result["reason"] = (
+                    f"尺寸 {webp.width}×{webp.height} 与原图 {width}×{height} 不符"
+                )
+                return result
+            frames = getattr(source, "n_frames", 1)
+            if getattr(webp, "n_frames", 1) != frames:
+                result["reason"] = (
+                    f"帧数 {getattr(webp, 'n_frames', 1)} 与原图 {frames} 不符"
+                )
+                return result
+            for frame in range(frames):
+                webp.seek(frame)
+                webp.load()
+
+            if max_diff is not None:
+                webp.seek(0)
+                source.seek(0)
+                if source.format == "JPEG":
+                    source.draft("RGB", webp.size)
+                source = ImageOps.exif_transpose(source)
+                difference = pixel_difference(webp, source)
+                result["difference"] = difference
+                if difference > max_diff:
+                    result["reason"] = (
+                        f"与原图的平均像素差异 {difference:.2f} 超过 {max_diff}"
+                    )
+                    return result
+        result["ok"] = True
+    except Exception as e:
+        result["reason"] = f"校验时出错: {str(e)}"
+    return result
+
+
+def verify_webp_outputs(
+    pairs, workers=None, max_diff=None, verbose=False, log_path=None
+):
+    """并行校验原图对应的转换结果，见 verify_webp
+    Args:
+        pairs: [(原图路径, 输出路径)]
+        workers: 并行进程数，默认为CPU核心数
+        max_diff: 与原图允许的最大平均像素差异（0-255，需要 numpy），默认不比较像素
+        verbose: 是否逐个输出校验结果
+        log_path: 逐个文件信息的日志路径，见 ProgressReporter
+    Returns:
+        (verified, failures): 通过校验的原图列表，未通过的 verify_webp 结果列表
+    """
+    workers = workers or os.cpu_count() or 1
+    jobs = [(path, output_path, max_diff) for path, output_path in pairs]
+    # 校验以解码为主，是CPU密集，用进程池
+    if workers <= 1 or len(jobs) <= 1:
+        results = map(verify_webp, jobs)
+        executor = None
+    else:
+        executor = ProcessPoolExecutor(max_workers=workers)
+        results = executor.map(
+            verify_webp, jobs, chunksize=max(1, len(jobs) // (workers * 4))
+        )
+
+    verified = []
+    failures = []
+    progress = ProgressReporter(len(jobs), "校验", verbose, log_path)
+    try:
+        for result in results:
+            if result["ok"]:
+                verified.append(result["path"])
+                progress.detail(f"校验通过: {result['webp']}")
+            else:
+                failures.append(result)
+                progress.detail(f"校验未通过: {result['webp']}（{result['reason']}）")
+            progress.advance()
+    finally:
+        progress.close()
+        if executor:
+            executor.shutdown()
+    return verified, failures
+
+
+def delete_original_images(
+    folder_path,
+    backup=None,
+    webp_index=None,
+    scan=None,
+    verbose=False,
+    log_path=None,
+    reference_index=None,
+    allow_referenced=False,
+    workers=None,
+    max_diff=None,
+):
+    """删除已转换为webp的原始图片，仍被Markdown引用的原图默认不删除
+
+    删除前先并行校验每个webp（见 verify_webp），未通过的原图不会删除，
+    然后分批并发删除，最后汇总校验和删除的结果。
     Args:
         folder_path: 文件夹路径
+        backup: 是否备份要删除的文件，None 表示询问用户
+        webp_index: 已建立的 WebpIndex，默认重新扫描
+        scan: 已完成的 SiteScan，默认重新扫描
+        verbose: 是否逐个输出删除的文件，默认只显示进度
+        log_path: 逐个文件信息的日志路径，见 ProgressReporter
+        reference_index: 已加载的 ReferenceIndex，默认从站点目录加载
+        allow_referenced: 是否连仍被引用的原图一起删除
+        workers: 并行校验的进程数，默认为CPU核心数
+        max_diff: 校验时与原图允许的最大平均像素差异（0-255，需要 numpy），默认不比较像素
     Returns:
         deleted_count: 删除的文件数量
     """
+    if scan is None:
+        scan = SiteScan(folder_path)
+    if webp_index is None:
+        webp_index = WebpIndex(folder_path, scan=scan)
+
     # 首先收集要删除的文件
-    files_to_delete = []
-    for root, dirs, files in os.walk(folder_path):
-        for file in files:
-            if file.lower().endswith((".png", ".jpg", ".jpeg", ".bmp", ".tiff")):
-                file_path = os.path.join(root, file)
-                webp_path = os.path.splitext(file_path)[0] + ".webp"
+    outputs = {}
+    for file_path in scan.images:
+        output_path = webp_index.output_for(webp_output_path(file_path))
+        if output_path:
+            outputs[file_path] = output_path
+    files_to_delete = list(outputs)
+
+    # 还有文章指向原图时删除会导致图片失效
+    if reference_index is None:
+        reference_index = ReferenceIndex(folder_path, webp_index.static_roots)
+    reference_index.update(scan.markdown, scan.stat)
+    reference_index.save()
+    referenced = [
+        path for path in files_to_delete if reference_index.is_referenced(path)
+    ]
+    if referenced and not allow_referenced:
+        print(
+            f"\n{Fore.YELLOW}{len(referenced)} 个原图仍被Markdown引用，不会删除，"
+            f"请先更新引用：{Style.RESET_ALL}"
+        )
+        for path in referenced[:10]:
+            md_path = reference_index.referencing(path)[0][0]
+            print(f"{path}  <-  {md_path}")
+        if len(referenced) > 10:
+            print(f"……以及其他 {len(referenced) - 10} 个文件")
+        referenced = set(referenced)
+        files_to_delete = [path for path in files_to_delete if path not in referenced]
 
-                if os.path.exists(webp_path):
-                    files_to_delete.append(file_path)
+    # 中断过的运行可能留下空的或不完整的输出，校验通过才删除原图
+    if files_to_delete:
+        print(f"\n正在校验 {len(files_to_delete)} 个转换结果...")
+        files_to_delete, failures = verify_webp_outputs(
+            [(path, outputs[path]) for path in files_to_delete],
+            workers,
+            max_diff,
+            verbose,
+            log_path,
+        )
+        if failures:
+            print(
+                f"\n{Fore.YELLOW}{len(failures)} 个转换结果未通过校验，对应的原图不会删除，"
+                f"建议重新转换：{Style.RESET_ALL}"
+            )
+            for result in failures[:10]:
+                print(f"{result['webp']}: {result['reason']}")
+            if len(failures) > 10:
+                print(f"……以及其他 {len(failures) - 10} 个文件")
+    else:
+        failures = []
 
     if not files_to_delete:
         print("\n没有找到可删除的文件。")
         return 0
 
     print(f"\n找到 {len(files_to_delete)} 个可删除的文件：")
-    for file in files_to_delete:
-        print(file)
+    preview_files(files_to_delete)
 
     # 询问是否要备份要删除的文件
-    if (
-        input(
-            f"\n{Fore.YELLOW}是否要备份这些即将删除的文件？(y/n，默认y): {Style.RESET_ALL}"
+    interactive = backup is None
+    if interactive:
+        backup = (
+            input(
+                f"\n{Fore.YELLOW}是否要备份这些即将删除的文件？(y/n，默认y): {Style.RESET_ALL}"
+            )
+            .strip()
+            .lower()
+            != "n"
         )
-        .strip()
-        .lower()
-        != "n"
-    ):
+    if backup:
         if not backup_files_to_delete(folder_path, files_to_delete):
+            # 非交互模式下备份失败直接放弃删除
             if (
-                input(
+                not interactive
+                or input(
                     f"\n{Fore.RED}备份失败，是否继续删除操作？(y/n，默认n): {Style.RESET_ALL}"
                 )
                 .strip()
@@ -89,42 +572,511 @@ def delete_original_images(folder_path):
             ):
                 return 0
 
-    # 执行删除操作
-    deleted_count = 0
-    for file_path in files_to_delete:
+    def remove_one(file_path):
         try:
+            size = scan.stat(file_path).st_size
             os.remove(file_path)
-            deleted_count += 1
-            print(f"已删除: {file_path}")
+            return file_path, size, None
         except Exception as e:
-            print(f"{Fore.RED}删除文件 {file_path} 时出错: {str(e)}{Style.RESET_ALL}")
+            return file_path, 0, e
+
+    # 分批并发删除，每批结束后刷新一次进度
+    deleted_count = 0
+    freed_bytes = 0
+    delete_errors = 0
+    progress = ProgressReporter(len(files_to_delete), "删除", verbose, log_path)
+    with ThreadPoolExecutor(max_workers=(workers or os.cpu_count() or 1) * 2) as pool:
+        for start in range(0, len(files_to_delete), DELETE_BATCH_SIZE):
+            batch = files_to_delete[start : start + DELETE_BATCH_SIZE]
+            for file_path, size, error in pool.map(remove_one, batch):
+                if error:
+                    delete_errors += 1
+                    progress.warn(f"删除文件 {file_path} 时出错: {str(error)}")
+                    progress.advance()
+                    continue
+                deleted_count += 1
+                freed_bytes += size
+                progress.detail(f"已删除: {file_path}")
+                progress.advance(nbytes=size)
+    progress.close()
 
+    print(
+        f"\n校验通过 {len(files_to_delete)} 个，未通过 {len(failures)} 个；"
+        f"已删除 {deleted_count} 个原图，释放 {freed_bytes / 1024 / 1024:.1f} MB"
+        + (f"，{delete_errors} 个删除失败" if delete_errors else "")
+    )
     return deleted_count
 
 
-def find_image_files(folder_path):
-    """递归查找所有图片文件"""
-    image_extensions = (".png", ".jpg", ".jpeg", ".bmp", ".tiff")
-    image_files = []
+class ScanEntry(namedtuple("ScanEntry", ["kind", "path", "dir_entry"])):
+    """扫描到的一个文件，kind 为 "image"、"markdown" 或 "webp" """
+
+    __slots__ = ()
+
+    def stat(self):
+        # DirEntry 会缓存 stat 结果，后续阶段重复获取不会再产生系统调用
+        return self.dir_entry.stat()
+
+
+def classify_file(name):
+    """根据文件名判断文件类型，不关心的文件返回None"""
+    lower_name = name.lower()
+    if lower_name.endswith(IMAGE_EXTENSIONS):
+        return "image"
+    if lower_name.endswith(MARKDOWN_EXTENSIONS):
+        return "markdown"
+    # 多格式转换生成的 avif 与webp同样算作转换结果
+    if lower_name.endswith(OUTPUT_EXTENSIONS):
+        return "webp"
+    return None
+
+
+def _matches_any(rel_path, name, patterns):
+    """文件名或相对路径是否匹配任意一个glob，以 / 开头的glob只与相对站点根目录的路径比较"""
+    for pattern in patterns:
+        if pattern.startswith("/"):
+            if fnmatch.fnmatch(rel_path, pattern[1:]):
+                return True
+        elif fnmatch.fnmatch(name, pattern) or fnmatch.fnmatch(rel_path, pattern):
+            return True
+    return False
+
+
+def scan_tree(folder_path, include=None, exclude=DEFAULT_EXCLUDES):
+    """基于 os.scandir 的流式遍历，边遍历边返回图片、Markdown和webp文件
+    Args:
+        folder_path: 文件夹路径
+        include: 只返回匹配这些glob的文件（相对路径或文件名），默认全部
+        exclude: 跳过匹配这些glob的目录和文件
+    Yields:
+        ScanEntry
+    """
+    exclude = tuple(exclude or ())
+    stack = [folder_path]
+    while stack:
+        current_dir = stack.pop()
+        try:
+            with os.scandir(current_dir) as it:
+                entries = list(it)
+        except OSError as e:
+            print(f"{Fore.YELLOW}无法读取目录 {current_dir}: {str(e)}{Style.RESET_ALL}")
+            continue
+
+        subdirs = []
+        for entry in entries:
+            rel_path = os.path.relpath(entry.path, folder_path).replace(os.sep, "/")
+            if exclude and _matches_any(rel_path, entry.name, exclude):
+                continue
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                    continue
+                if not entry.is_file():
+                    continue
+            except OSError:
+                continue
+            kind = classify_file(entry.name)
+            if kind is None:
+                continue
+            if include and not _matches_any(rel_path, entry.name, include):
+                continue
+            yield ScanEntry(kind, entry.path, entry)
+        # 倒序入栈，保持与 os.walk 相近的遍历顺序
+        stack.extend(reversed(subdirs))
+
+
+class SiteScan:
+    """对站点目录的一次完整扫描，供转换、更新引用、删除等阶段共用"""
+
+    def __init__(self, folder_path, include=None, exclude=DEFAULT_EXCLUDES):
+        self.folder_path = folder_path
+        self.images = []
+        self.markdown = []
+        self.webp = []
+        self.entries = {}
+        for scan_entry in scan_tree(folder_path, include, exclude):
+            self.entries[scan_entry.path] = scan_entry
+            if scan_entry.kind == "image":
+                self.images.append(scan_entry.path)
+            elif scan_entry.kind == "markdown":
+                self.markdown.append(scan_entry.path)
+            else:
+                self.webp.append(scan_entry.path)
+
+    def refresh(self, paths):
+        """文件被新建、修改或删除后更新扫描结果，之后的 stat 会重新读取"""
+        for path in paths:
+            self.entries.pop(path, None)
+            kind = classify_file(os.path.basename(path))
+            files = {"image": self.images, "markdown": self.markdown}.get(
+                kind, self.webp
+            )
+            exists = os.path.isfile(path)
+            if exists and path not in files:
+                files.append(path)
+            elif not exists and path in files:
+                files.remove(path)
+
+    def stat(self, path):
+        """优先使用扫描时缓存的 stat 结果"""
+        scan_entry = self.entries.get(path)
+        if scan_entry is not None:
+            try:
+                return scan_entry.stat()
+            except OSError:
+                pass
+        return os.stat(path)
 
-    for root, dirs, files in os.walk(folder_path):
-        for file in files:
-            if file.lower().endswith(image_extensions):
-                image_files.append(os.path.join(root, file))
 
-    return image_files
+def find_image_files(folder_path, include=None, exclude=DEFAULT_EXCLUDES):
+    """递归查找所有图片文件"""
+    return [
+        scan_entry.path
+        for scan_entry in scan_tree(folder_path, include, exclude)
+        if scan_entry.kind == "image"
+    ]
 
 
-def find_markdown_files(folder_path):
+def find_markdown_files(folder_path, include=None, exclude=DEFAULT_EXCLUDES):
     """递归查找所有Markdown文件"""
-    markdown_files = []
+    return [
+        scan_entry.path
+        for scan_entry in scan_tree(folder_path, include, exclude)
+        if scan_entry.kind == "markdown"
+    ]
+
+
+def find_static_roots(folder_path):
+    """Hugo 的 static 目录：文件夹本身是站点根目录，或者是站点下的 content 目录"""
+    folder_path = os.path.abspath(folder_path)
+    candidates = [os.path.join(folder_path, "static")]
+    if os.path.basename(folder_path) == "content":
+        candidates.append(os.path.join(os.path.dirname(folder_path), "static"))
+    return [root for root in candidates if os.path.isdir(root)]
+
+
+class WebpIndex:
+    """一次扫描建立的webp文件索引，代替逐个引用调用 os.path.exists
+
+    除了处理的文件夹本身，还会索引 Hugo 的 static 目录，
+    这样 "/images/a.jpg" 这种站点绝对路径的引用也能找到对应的webp。
+    """
+
+    def __init__(self, folder_path, static_roots=None, scan=None):
+        self.folder_path = os.path.abspath(folder_path)
+        if static_roots is None:
+            static_roots = find_static_roots(self.folder_path)
+        self.static_roots = [os.path.abspath(root) for root in static_roots]
+        self.paths = set()
+        # 规范化的webp路径 -> 已生成的响应式宽度
+        self.variants = {}
+        # 规范化的输出路径（不含扩展名）-> 多格式转换选出的扩展名
+        self.chosen = {}
+        self.scan(scan)
+
+    @staticmethod
+    def _normalize(path):
+        return os.path.normcase(os.path.abspath(path))
+
+    def scan(self, site_scan=None):
+        """重新扫描所有根目录
+        Args:
+            site_scan: 已完成的 SiteScan，提供时直接复用其中的webp文件列表
+        """
+        self.paths.clear()
+        self.variants.clear()
+        roots = [
+            root
+            for root in self.static_roots
+            if not root.startswith(self.folder_path + os.sep)
+        ]
+        if site_scan is not None:
+            for path in site_scan.webp:
+                self.add(path)
+        else:
+            roots.insert(0, self.folder_path)
+        for root_dir in roots:
+            for scan_entry in scan_tree(root_dir, exclude=()):
+                if scan_entry.kind == "webp":
+                    self.add(scan_entry.path)
+        # 只有 avif 存在时才需要读取转换记录中的选择
+        self.chosen.clear()
+        if any(path.endswith(".avif") for path in self.paths):
+            manifest = ConversionManifest(self.folder_path)
+            for entry in manifest.entries.values():
+                if entry.get("output"):
+                    self.choose(os.path.join(self.folder_path, entry["output"]))
+
+    def choose(self, output_path):
+        """记录多格式转换选出的输出，引用会指向它"""
+        stem, ext = os.path.splitext(self._normalize(output_path))
+        self.chosen[stem] = ext
+
+    def add(self, path):
+        """本次运行新生成了webp文件时同步更新索引"""
+        normalized = self._normalize(path)
+        self.paths.add(normalized)
+        match = RESPONSIVE_PATTERN.match(normalized)
+        if match:
+            self.variants.setdefault(match.group(1) + ".webp", set()).add(
+                int(match.group(2))
+            )
+
+    def discard(self, path):
+        normalized = self._normalize(path)
+        self.paths.discard(normalized)
+        match = RESPONSIVE_PATTERN.match(normalized)
+        if match:
+            self.variants.get(match.group(1) + ".webp", set()).discard(
+                int(match.group(2))
+            )
+
+    def resolve(self, path):
+        """返回索引中对应的webp路径，不存在时返回None"""
+        normalized = self._normalize(path)
+        if normalized in self.paths:
+            return normalized
+        # 以 / 开头的引用在 Hugo 中指向 static 目录
+        if os.path.isabs(path):
+            rel_path = os.path.splitdrive(path)[1].lstrip("/\\")
+            for root in self.static_roots:
+                normalized = self._normalize(os.path.join(root, rel_path))
+                if normalized in self.paths:
+                    return normalized
+        return None
+
+    def exists(self, path):
+        """判断webp文件是否存在"""
+        return self.resolve(path) is not None
+
+    __contains__ = exists
+
+    def output_for(self, path):
+        """图片引用应指向的转换结果
+        Args:
+            path: 图片对应的webp路径
+        Returns:
+            output_path: 与 path 写法相同的输出路径，优先多格式转换选出的格式，
+                其次webp；都不存在时返回None
+        """
+        stem = os.path.splitext(path)[0]
+        found = []
+        for ext in OUTPUT_EXTENSIONS:
+            resolved = self.resolve(stem + ext)
+            if resolved:
+                if self.chosen.get(os.path.splitext(resolved)[0]) == ext:
+                    return stem + ext
+                found.append(stem + ext)
+        return found[0] if found else None
+
+    def srcset_variants(self, path):
+        """列出webp文件可用于 srcset 的所有尺寸
+        Args:
+            path: webp文件路径
+        Returns:
+            [(宽度描述, 响应式宽度)]，原图的响应式宽度为None；没有响应式版本时返回空列表
+        """
+        resolved = self.resolve(path)
+        widths = sorted(self.variants.get(resolved, ())) if resolved else []
+        if not widths:
+            return []
+        variants = [(width, width) for width in widths]
+        try:
+            with Image.open(resolved) as image:
+                variants.append((image.width, None))
+        except Exception:
+            pass
+        return variants
+
+
+class ReferenceIndex:
+    """图片到引用它的Markdown文件的反向索引，保存在站点目录下，按文件状态增量更新
+
+    每个Markdown文件记录修改时间、大小以及其中的所有图片引用
+    （解析后的图片路径、原始写法、字符位置和引用类型），
+    文件没有变化时不会重新读取。路径均为相对站点目录的路径。
+    """
+
+    VERSION = 1
+
+    def __init__(self, folder_path, static_roots=None):
+        self.folder_path = os.path.abspath(folder_path)
+        self.index_path = os.path.join(self.folder_path, REFERENCE_INDEX_NAME)
+        if static_roots is None:
+            static_roots = find_static_roots(self.folder_path)
+        self.static_roots = [os.path.abspath(root) for root in static_roots]
+        # Markdown相对路径 -> {"mtime_ns", "size", "references": [[图片, 原始写法, start, end, 类型]]}
+        self.posts = {}
+        self.images = {}
+        self.load()
+
+    def _key(self, path):
+        return os.path.relpath(os.path.abspath(path), self.folder_path).replace(
+            os.sep, "/"
+        )
+
+    def _path(self, key):
+        return os.path.normpath(os.path.join(self.folder_path, key))
+
+    def load(self):
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if data.get("version") == self.VERSION:
+            self.posts = data.get("posts", {})
+            self._rebuild_images()
+
+    def save(self):
+        data = {"version": self.VERSION, "posts": self.posts}
+        write_atomic(
+            self.index_path, json.dumps(data, ensure_ascii=False).encode("utf-8")
+        )
+
+    def _rebuild_images(self):
+        self.images = {}
+        for md_key, post in self.posts.items():
+            for image_key, _, start, end, ref_type in post["references"]:
+                self.images.setdefault(image_key, []).append(
+                    (md_key, start, end, ref_type)
+                )
+
+    def resolve(self, img_path, md_dir):
+        """把引用中的路径解析为图片文件的位置，外部链接返回None"""
+        img_path = img_path.split("?", 1)[0].split("#", 1)[0]
+        if not img_path or "://" in img_path or img_path.startswith("data:"):
+            return None
+        if img_path.startswith("/"):
+            # 以 / 开头的引用在 Hugo 中指向 static 目录
+            rel_path = img_path.lstrip("/")
+            candidates = [os.path.join(root, rel_path) for root in self.static_roots]
+            for candidate in candidates:
+                if os.path.exists(candidate):
+                    return candidate
+            return (
+                candidates[0]
+                if candidates
+                else os.path.join(self.folder_path, rel_path)
+            )
+        return os.path.normpath(os.path.join(md_dir, img_path))
+
+    def _index_content(self, md_path, content):
+        references = []
+        md_dir = os.path.dirname(os.path.abspath(md_path))
+        for start, end, ref_type, _ in iter_image_paths(content):
+            img_path = content[start:end]
+            if not img_path.lower().endswith(IMAGE_EXTENSIONS + (".webp",)):
+                continue
+            image_path = self.resolve(img_path, md_dir)
+            if image_path:
+                references.append(
+                    [self._key(image_path), img_path, start, end, ref_type]
+                )
+        return references
+
+    def update(self, markdown_files, stat=os.stat, prune=True, workers=None):
+        """重新索引有变化的Markdown文件
+        Args:
+            markdown_files: 当前所有（prune=False 时为部分）Markdown文件
+            stat: 获取文件 stat 的函数
+            prune: 是否移除不在 markdown_files 中的文件
+            workers: 读取文件的线程数
+        Returns:
+            updated_count: 重新索引的文件数量
+        """
+        changed = []
+        seen = set()
+        for md_path in markdown_files:
+            md_key = self._key(md_path)
+            seen.add(md_key)
+            try:
+                file_stat = stat(md_path)
+            except OSError:
+                self.posts.pop(md_key, None)
+                continue
+            post = self.posts.get(md_key)
+            if (
+                post is None
+                or post["mtime_ns"] != file_stat.st_mtime_ns
+                or post["size"] != file_stat.st_size
+            ):
+                changed.append((md_path, md_key, file_stat))
+        if prune:
+            for md_key in self.posts.keys() - seen:
+                del self.posts[md_key]
+
+        def read(item):
+            try:
+                return read_text_file(item[0])
+            except (OSError, UnicodeDecodeError) as e:
+                print(f"读取Markdown文件 {item[0]} 时出错: {str(e)}")
+                return ""
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for (md_path, md_key, file_stat), content in zip(
+                changed, executor.map(read, changed)
+            ):
+                self.posts[md_key] = {
+                    "mtime_ns": file_stat.st_mtime_ns,
+                    "size": file_stat.st_size,
+                    "references": self._index_content(md_path, content),
+                }
+        self._rebuild_images()
+        return len(changed)
 
-    for root, dirs, files in os.walk(folder_path):
-        for file in files:
-            if file.lower().endswith((".md", ".markdown")):
-                markdown_files.append(os.path.join(root, file))
+    def referencing(self, image_path):
+        """引用该图片的位置列表: [(Markdown文件路径, start, end, 引用类型)]"""
+        return [
+            (self._path(md_key), start, end, ref_type)
+            for md_key, start, end, ref_type in self.images.get(
+                self._key(image_path), ()
+            )
+        ]
+
+    def is_referenced(self, image_path):
+        return self._key(image_path) in self.images
+
+    def posts_referencing(self, image_paths):
+        """引用了其中任意一张图片的Markdown文件"""
+        posts = set()
+        for image_path in image_paths:
+            posts.update(
+                self._path(md_key)
+                for md_key, _, _, _ in self.images.get(self._key(image_path), ())
+            )
+        return posts
+
+    def posts_with_replaceable(self, find_output):
+        """还有引用可以替换为webp的Markdown文件，与 find_image_references 的判断一致
+        Args:
+            find_output: 查找引用应指向的输出的函数，如 WebpIndex.output_for
+        """
+        posts = []
+        for md_key, post in self.posts.items():
+            md_path = self._path(md_key)
+            md_dir = os.path.dirname(md_path)
+            if any(
+                resolve_webp_reference(img_path, md_dir, find_output)
+                for _, img_path, _, _, _ in post["references"]
+            ):
+                posts.append(md_path)
+        return posts
+
+    def orphans(self, files):
+        """没有被任何Markdown引用的图片和webp
 
-    return markdown_files
+        原图和同名webp互相算作被引用，响应式版本跟随对应的webp。
+        """
+        used_stems = {os.path.splitext(key)[0] for key in self.images}
+        orphans = []
+        for path in files:
+            key = self._key(path)
+            match = RESPONSIVE_PATTERN.match(key)
+            stem = match.group(1) if match else os.path.splitext(key)[0]
+            if stem not in used_stems:
+                orphans.append(path)
+        return orphans
 
 
 def show_introduction():
@@ -137,6 +1089,7 @@ def show_introduction():
     print("使用 Pillow 库进行图片转换")
     print("支持有损和无损转换")
     print("支持自定义压缩质量")
+    print("GIF 和 APNG 动图转换为 webp 动图，保留帧时长和循环次数")
 
     print(f"\n{Fore.YELLOW}功能说明：{Style.RESET_ALL}")
     print("1. 将图片批量转换为 webp 格式")
@@ -196,9 +1149,7 @@ def show_warning():
     print(f"{Fore.RED}2. 脚本处于调试阶段，缺乏测试，请勿过度依赖{Style.RESET_ALL}")
     print(f"{Fore.RED}3. 数据无价，请谨慎操作，一定要备份！！！{Style.RESET_ALL}")
 
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    backup_dir = os.path.join(script_dir, "backup")
-    print(f"\n{Fore.YELLOW}备份将保存在: {backup_dir}{Style.RESET_ALL}")
+    print(f"\n{Fore.YELLOW}备份将保存在: {get_backup_dir()}{Style.RESET_ALL}")
 
     backup_response = (
         input(f"\n{Fore.YELLOW}是否需要创建备份？(y/n，默认y): {Style.RESET_ALL}")
@@ -217,27 +1168,9 @@ def backup_files_to_delete(folder_path, files_to_delete):
         backup_path: 备份文件夹路径
     """
     try:
-        # 创建backup文件夹
-        script_dir = os.path.dirname(os.path.abspath(__file__))
-        backup_dir = os.path.join(script_dir, "backup")
-        if not os.path.exists(backup_dir):
-            os.makedirs(backup_dir)
-
-        # 使用时间戳创建唯一的备份文件夹
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        backup_path = os.path.join(backup_dir, f"deleted_files_backup_{timestamp}")
-
-        # 创建备份目录结构
-        for file_path in files_to_delete:
-            # 获取相对路径
-            rel_path = os.path.relpath(file_path, folder_path)
-            # 构建备份路径
-            backup_file_path = os.path.join(backup_path, rel_path)
-            # 创建目录结构
-            os.makedirs(os.path.dirname(backup_file_path), exist_ok=True)
-            # 复制文件
-            shutil.copy2(file_path, backup_file_path)
-
+        backup_path = create_snapshot(
+            folder_path, files_to_delete, prefix="deleted_files_backup"
+        )
         print(f"\n{Fore.GREEN}已备份要删除的文件到: {backup_path}{Style.RESET_ALL}")
         return backup_path
     except Exception as e:
@@ -245,346 +1178,1346 @@ def backup_files_to_delete(folder_path, files_to_delete):
         return None
 
 
-def replace_image_references(markdown_path, need_confirm=True):
-    """替换Markdown文件中的图片引用为webp格式
-    Args:
-        markdown_path: Markdown文件路径
-        need_confirm: 是否需要逐个确认替换
-    """
-    try:
-        with open(markdown_path, "r", encoding="utf-8") as f:
-            content = f.read()
-
-        # 分离YAML前置元数据和正文内容
-        yaml_match = re.match(r"^---\n(.*?)\n---\n", content, re.DOTALL)
-        if yaml_match:
-            yaml_content = yaml_match.group(1)
-            main_content = content[yaml_match.end() :]
-
-            # 处理YAML中的图片引用
-            yaml_changed = False
-            try:
-                yaml_data = yaml.safe_load(yaml_content)
-                if yaml_data and isinstance(yaml_data, dict):
-                    # 检查并更新image字段
-                    if "image" in yaml_data:
-                        img_path = yaml_data["image"]
-                        if isinstance(img_path, str):
-                            base_name = os.path.splitext(img_path)[0]
-                            ext = os.path.splitext(img_path)[1].lower()
-                            if ext in [".png", ".jpg", ".jpeg", ".bmp", ".tiff"]:
-                                webp_path = base_name + ".webp"
-                                if os.path.exists(
-                                    os.path.join(
-                                        os.path.dirname(markdown_path), webp_path
-                                    )
-                                ):
-                                    print(f"\n处理文件: {markdown_path}")
-                                    print(f"在YAML中发现图片引用: {img_path}")
-                                    print(f"可替换为: {webp_path}")
-                                    if need_confirm:
-                                        response = (
-                                            input("是否替换？(y/n/gg，默认n): ")
-                                            .strip()
-                                            .lower()
-                                        )
-                                        if response == "gg":
-                                            need_confirm = False
-                                            content = content.replace(
-                                                img_path, webp_path
-                                            )
-                                            yaml_changed = True
-                                            print(
-                                                f"{Fore.YELLOW}切换到自动替换模式{Style.RESET_ALL}"
-                                            )
-                                        elif response == "y":
-                                            content = content.replace(
-                                                img_path, webp_path
-                                            )
-                                            yaml_changed = True
-                                    else:
-                                        # 自动批处理模式，直接替换
-                                        content = content.replace(img_path, webp_path)
-                                        yaml_changed = True
-                                        print(
-                                            f"{Fore.GREEN}已自动替换{Style.RESET_ALL}"
-                                        )
-            except yaml.YAMLError:
-                print(f"处理 {markdown_path} 的YAML数据时出错")
-        else:
-            yaml_content = ""
-            main_content = content
-            yaml_changed = False
-
-        # 处理正文中的图片引用
-        # 匹配各种图片引用格式
-        img_patterns = [
-            (
-                r"!\[([^\]]*?)\]\(([^)]+?)\)",
-                "Markdown格式",
-            ),  # Markdown 标准格式 ![alt](path)
-            (r"<img.*?src=[\'\"](.*?)[\'\"]", "HTML格式"),  # HTML 格式 <img src="path">
-            (
-                r'(?:\"|\s)([^"\s]+\.(?:jpg|jpeg|png|bmp|tiff))(?:\"|\s|$)',
-                "直接引用",
-            ),  # 裸露的图片路径，包括引号包围的情况
-            (
-                r'{{<\s*(?:imgrow|music)\s+(?:[^>}]*?\s+)?(?:img=)?\"([^"]+\.(?:jpg|jpeg|png|bmp|tiff))\"',
-                "Hugo Shortcode",
-            ),  # Hugo shortcode中的img属性
-            (r"{{<\s*imgrow\s+([^>}]*?)>}}", "Hugo Imgrow"),  # Hugo imgrow shortcode
-        ]
+# 一次扫描即可找出正文中所有类型的图片引用，按出现位置依次匹配，互不重叠
+IMAGE_REFERENCE_PATTERN = re.compile(
+    # Markdown 标准格式 ![alt](path)
+    r"!\[[^\]]*?\]\((?P<markdown>[^)]+?)\)"
+    # HTML 格式 <img src="path">
+    r"|<img\b[^>]*?\bsrc=[\'\"](?P<html>[^\'\"]*)[\'\"]"
+    # Hugo shortcode，imgrow 中可能有多张图片
+    r"|{{<\s*(?P<shortcode>imgrow|music)\b(?P<shortcode_body>[^>}]*?)>}}"
+    # 裸露的图片路径，包括引号包围的情况；webp 只用于引用索引，不会被替换
+    r"|(?<=[\"\s])(?P<direct>[^\"\s()\[\]<>{}]+\.(?:jpg|jpeg|png|bmp|tiff|gif|webp))(?=[\"\s]|$)"
+)
+SHORTCODE_IMAGE_PATTERN = re.compile(
+    r"\"([^\"]+\.(?:jpg|jpeg|png|bmp|tiff|gif|webp))\""
+)
+FRONT_MATTER_PATTERN = re.compile(r"^---\n(.*?)\n---\n", re.DOTALL)
 
-        def process_image_path(img_path, md_dir):
-            """处理图片路径，检查是否存在对应的webp文件"""
-            if not img_path:
-                return None
+# 这两类引用只是文本中的文件名，误判的可能性更大，需要额外提醒
+DIRECT_REFERENCE_TYPES = ("直接引用", "Hugo Imgrow内图片")
 
-            # 移除URL参数
-            # img_path = img_path.split('?')[0]
 
-            # 检查文件扩展名
-            ext = os.path.splitext(img_path)[1].lower()
-            if ext not in [".png", ".jpg", ".jpeg", ".bmp", ".tiff"]:
-                return None
+class ImageReference(
+    namedtuple(
+        "ImageReference",
+        ["start", "end", "old_path", "new_path", "ref_type", "context"],
+    )
+):
+    """正文中的一处图片引用，start/end 为图片路径在整个文件内容中的位置"""
 
-            # 构建webp路径
-            base_path = os.path.splitext(img_path)[0]
-            webp_path = base_path + ".webp"
+    __slots__ = ()
 
-            # 检查webp文件是否存在
-            full_webp_path = (
-                os.path.join(md_dir, webp_path)
-                if not os.path.isabs(webp_path)
-                else webp_path
-            )
-            if os.path.exists(full_webp_path):
-                return webp_path
-            return None
 
-        def process_imgrow_shortcode(content):
-            """处理 Hugo imgrow shortcode 中的所有图片引用"""
-            pattern = r'\"([^"]+\.(?:jpg|jpeg|png|bmp|tiff))\"'
-            matches = []
-
-            def collect_matches(match):
-                img_path = match.group(1)
-                matches.append((img_path, match.start(1), match.end(1)))
-                return match.group(0)
-
-            re.sub(pattern, collect_matches, content)
-            return matches
-
-        def replace_match(pattern_info, content, md_dir):
-            pattern, pattern_type = pattern_info
-            replacements = []
-            nonlocal need_confirm
-
-            def get_context(content, start_pos, end_pos):
-                """获取替换位置的上下文"""
-                context_start = max(0, start_pos - 5)
-                context_end = min(len(content), end_pos + 5)
-                before = content[context_start:start_pos]
-                after = content[end_pos:context_end]
-                return before, after
-
-            def collect_replacement(match):
-                if pattern_type == "Hugo Imgrow":
-                    # 处理整个 imgrow shortcode
-                    shortcode_content = match.group(1)
-                    img_matches = process_imgrow_shortcode(shortcode_content)
-
-                    for img_path, start, end in img_matches:
-                        webp_path = process_image_path(img_path, md_dir)
-                        if webp_path:
-                            # 计算在原始内容中的位置
-                            abs_start = match.start(1) + start
-                            abs_end = match.start(1) + end
-                            before, after = get_context(content, abs_start, abs_end)
-                            replacements.append(
-                                (
-                                    img_path,
-                                    webp_path,
-                                    img_path,
-                                    webp_path,
-                                    (before, after),
-                                    "Hugo Imgrow内图片",
-                                )
-                            )
-                    return match.group(0)
-                elif pattern_type in ["Markdown格式", "HTML格式", "Hugo Shortcode"]:
-                    img_path = (
-                        match.group(2)
-                        if pattern_type == "Markdown格式"
-                        else match.group(1)
-                    )
-                    webp_path = process_image_path(img_path, md_dir)
-                    if webp_path:
-                        if pattern_type == "Markdown格式":
-                            new_text = f"![{match.group(1)}]({webp_path})"
-                        elif pattern_type == "HTML格式":
-                            new_text = match.group(0).replace(img_path, webp_path)
-                        else:  # Hugo Shortcode
-                            new_text = match.group(0).replace(img_path, webp_path)
-                        replacements.append(
-                            (
-                                match.group(0),
-                                new_text,
-                                img_path,
-                                webp_path,
-                                None,
-                                pattern_type,
-                            )
-                        )
-                else:  # 直接引用
-                    img_path = match.group(1)
-                    webp_path = process_image_path(img_path, md_dir)
-                    if webp_path:
-                        before, after = get_context(
-                            content, match.start(1), match.end(1)
-                        )
-                        replacements.append(
-                            (
-                                img_path,
-                                webp_path,
-                                img_path,
-                                webp_path,
-                                (before, after),
-                                "直接引用",
-                            )
-                        )
-                return match.group(0)
+def existing_output(webp_path):
+    """不借助索引查找图片的转换结果，优先webp，见 WebpIndex.output_for"""
+    stem = os.path.splitext(webp_path)[0]
+    for ext in OUTPUT_EXTENSIONS:
+        if os.path.exists(stem + ext):
+            return stem + ext
+    return None
 
-            # 先收集所有可能的替换
-            re.sub(pattern, collect_replacement, content)
 
-            # 如果有可替换项
-            if replacements:
-                # 检查是否有直接引用的情况
-                has_direct_refs = any(
-                    r[5] in ["直接引用", "Hugo Imgrow内图片"] for r in replacements
-                )  # Imgrow 是我主题的shortcode 用来展示图片的
+def resolve_webp_reference(img_path, md_dir, find_output=existing_output):
+    """检查图片路径是否存在对应的webp（或多格式转换选出的 avif）文件
+    Args:
+        img_path: 引用中的图片路径
+        md_dir: Markdown文件所在目录
+        find_output: 由webp路径找到引用应指向的输出的函数，如 WebpIndex.output_for
+    Returns:
+        webp_path: 替换后的引用路径，不可替换时返回None
+    """
+    if not img_path:
+        return None
 
-                # 如果不需要逐个确认且有直接引用，先显示示例
-                if not need_confirm and has_direct_refs:
-                    print(
-                        f"\n{Fore.YELLOW}发现直接引用或Hugo Shortcode中的图片路径，这种情况需要特别注意！{Style.RESET_ALL}"
-                    )
-                    print(
-                        f"\n{Fore.YELLOW}注意：只有当文件夹中存在对应的webp文件时，才会进行替换。{Style.RESET_ALL}"
-                    )
-                    print(
-                        f"{Fore.YELLOW}例如：如果文中有 555.jpg 这样的假装有表情包的表达，但文件夹中没有 555.webp ，则不会被替换。{Style.RESET_ALL}"
-                    )
-                    print("\n这些引用可能出现在文本中或Hugo Shortcode中，例如：")
-
-                    # 示例
-                    example_shown = False
-                    for old, new, old_path, new_path, context, ref_type in replacements:
-                        if ref_type in ["直接引用", "Hugo Imgrow内图片"]:
-                            before, after = context
-                            print(f"\n类型：{ref_type}")
-                            print(
-                                f"上下文示例：...{before}{Fore.RED}{old_path}{Style.RESET_ALL}{after}..."
-                            )
-                            print(
-                                f"将替换为：...{before}{Fore.GREEN}{new_path}{Style.RESET_ALL}{after}..."
-                            )
-                            print(
-                                f"{Fore.GREEN}（已确认存在对应的webp文件）{Style.RESET_ALL}"
-                            )
-                            example_shown = True
-                            break
+    # 检查文件扩展名
+    base_path, ext = os.path.splitext(img_path)
+    if ext.lower() not in IMAGE_EXTENSIONS:
+        return None
 
-                    if example_shown:
-                        response = (
-                            input("\n是否要替换这些图片路径？(y/n): ").strip().lower()
-                        )
-                        if response != "y":
-                            # 移除所有直接引用的替换
-                            replacements = [
-                                r
-                                for r in replacements
-                                if r[5] not in ["直接引用", "Hugo Imgrow内图片"]
-                            ]
-                        else:
-                            # 保险
-                            confirm_response = (
-                                input("是否要逐个确认这些替换？(y/n): ").strip().lower()
-                            )
-                            if confirm_response == "y":
-                                need_confirm = True
-
-                # 处理所有替换
-                if replacements:
-                    print(f"\n在{pattern_type}中发现以下可替换项：")
-                    for old, new, old_path, new_path, context, ref_type in replacements:
-                        print(f"\n[{ref_type}] 发现图片引用:")
-                        if ref_type in ["直接引用", "Hugo Imgrow内图片"]:
-                            before, after = context
-                            print(
-                                f"上下文：...{before}{Fore.RED}{old_path}{Style.RESET_ALL}{after}..."
-                            )
-                            print(
-                                f"替换为：...{before}{Fore.GREEN}{new_path}{Style.RESET_ALL}{after}..."
-                            )
-                            print(
-                                f"{Fore.GREEN}（已确认存在对应的webp文件）{Style.RESET_ALL}"
-                            )
-                        else:
-                            print(f"原始引用: {old_path}")
-                            print(f"替换为: {new_path}")
+    # 构建webp路径并检查是否存在
+    webp_path = base_path + ".webp"
+    full_webp_path = (
+        os.path.join(md_dir, webp_path) if not os.path.isabs(webp_path) else webp_path
+    )
+    output_path = find_output(full_webp_path)
+    if output_path:
+        return base_path + os.path.splitext(output_path)[1]
+    return None
 
-                        if need_confirm:
-                            response = (
-                                input("是否替换？(y/n/gg，默认n): ").strip().lower()
-                            )
-                            if response == "gg":
-                                need_confirm = False
-                                content = content.replace(old, new)
-                                print(
-                                    f"{Fore.YELLOW}切换到自动替换模式{Style.RESET_ALL}"
-                                )
-                            elif response == "y":
-                                content = content.replace(old, new)
-                        else:
-                            # 自动批处理模式，直接替换
-                            content = content.replace(old, new)
-                            print(f"{Fore.GREEN}已自动替换{Style.RESET_ALL}")
 
-            return content, bool(replacements)
+def build_srcset(webp_path, md_dir, srcset_variants):
+    """生成 srcset 属性值，没有响应式版本时返回None"""
+    full_webp_path = (
+        os.path.join(md_dir, webp_path) if not os.path.isabs(webp_path) else webp_path
+    )
+    candidates = []
+    for descriptor, width in srcset_variants(full_webp_path):
+        path = webp_path if width is None else responsive_webp_path(webp_path, width)
+        candidates.append(f"{path} {descriptor}w")
+    return ", ".join(candidates) if candidates else None
 
-        # 获取markdown文件所在目录
-        md_dir = os.path.dirname(markdown_path)
 
-        # 处理所有图片引用模式
-        main_content = content[yaml_match.end() :] if yaml_match else content
-        content_changed = False
+def iter_image_paths(content):
+    """一次扫描找出Markdown内容中所有图片路径，不关心是否有对应的webp
+    Args:
+        content: Markdown文件的完整内容
+    Yields:
+        (start, end, ref_type, srcset_at): 路径在内容中的位置和引用类型；
+            srcset_at 为可以插入 srcset 属性的位置，不能插入时为None
+    """
+    # 处理YAML前置元数据中的 image 字段
+    body_start = 0
+    front_matter = FRONT_MATTER_PATTERN.match(content)
+    if front_matter:
+        body_start = front_matter.end()
+        try:
+            yaml_data = yaml.safe_load(front_matter.group(1))
+        except yaml.YAMLError:
+            print("处理YAML数据时出错")
+            yaml_data = None
+        if isinstance(yaml_data, dict) and isinstance(yaml_data.get("image"), str):
+            img_path = yaml_data["image"]
+            if img_path:
+                yaml_start = front_matter.start(1)
+                pos = content.find(img_path, yaml_start, front_matter.end(1))
+                while pos != -1:
+                    yield pos, pos + len(img_path), "YAML image字段", None
+                    pos = content.find(
+                        img_path, pos + len(img_path), front_matter.end(1)
+                    )
 
-        for pattern_info in img_patterns:
-            new_main_content, changed = replace_match(
-                pattern_info, main_content, md_dir
+    # 处理正文中的图片引用
+    for match in IMAGE_REFERENCE_PATTERN.finditer(content, body_start):
+        group = match.lastgroup
+        if group == "shortcode_body":
+            ref_type = (
+                "Hugo Imgrow内图片"
+                if match.group("shortcode") == "imgrow"
+                else "Hugo Shortcode"
             )
-            if changed:
-                main_content = new_main_content
-                content_changed = True
+            body_offset = match.start("shortcode_body")
+            shortcode_body = match.group("shortcode_body")
+            for img_match in SHORTCODE_IMAGE_PATTERN.finditer(shortcode_body):
+                # 只有具名参数（img="..."）才能追加 srcset，位置参数不能与具名参数混用
+                srcset_at = None
+                if "srcset=" not in shortcode_body and re.search(
+                    r"\w+=\s*$", shortcode_body[: img_match.start()]
+                ):
+                    srcset_at = body_offset + img_match.end()
+                yield (
+                    body_offset + img_match.start(1),
+                    body_offset + img_match.end(1),
+                    ref_type,
+                    srcset_at,
+                )
+        elif group == "markdown":
+            yield match.start(group), match.end(group), "Markdown格式", None
+        elif group == "html":
+            tag_end = content.find(">", match.end())
+            srcset_at = (
+                match.end()
+                if "srcset" not in content[match.start() : tag_end]
+                else None
+            )
+            yield match.start(group), match.end(group), "HTML格式", srcset_at
+        else:
+            yield match.start(group), match.end(group), "直接引用", None
 
-        # 如果有任何修改，保存文件
-        if content_changed or yaml_changed:
-            if yaml_match:
-                final_content = content[: yaml_match.end()] + main_content
-            else:
-                final_content = main_content
 
-            with open(markdown_path, "w", encoding="utf-8") as f:
-                f.write(final_content)
-            return True
-        return False
+def find_image_references(
+    content, md_dir, find_output=existing_output, srcset_variants=None
+):
+    """找出Markdown内容中所有可替换为webp的图片引用
+    Args:
+        content: Markdown文件的完整内容
+        md_dir: Markdown文件所在目录
+        find_output: 查找引用应指向的输出的函数，见 resolve_webp_reference
+        srcset_variants: 提供时为 <img> 和具名参数的 shortcode 补充 srcset，
+            见 WebpIndex.srcset_variants
+    Returns:
+        references: 按位置排序的 ImageReference 列表
+    """
+    references = []
+    for start, end, ref_type, srcset_at in iter_image_paths(content):
+        img_path = content[start:end]
+        webp_path = resolve_webp_reference(img_path, md_dir, find_output)
+        if not webp_path:
+            continue
+        context = (content[max(0, start - 5) : start], content[end : end + 5])
+        references.append(
+            ImageReference(start, end, img_path, webp_path, ref_type, context)
+        )
+
+        # 在引号之后插入，start == end 表示纯插入
+        srcset = (
+            build_srcset(webp_path, md_dir, srcset_variants)
+            if srcset_variants and srcset_at is not None
+            else None
+        )
+        if srcset:
+            context = (content[max(0, srcset_at - 5) : srcset_at], "")
+            references.append(
+                ImageReference(
+                    srcset_at, srcset_at, "", f' srcset="{srcset}"', "srcset", context
+                )
+            )
+    return references
+
+
+def apply_image_references(content, references):
+    """按位置一次性拼接出替换后的内容
+    Args:
+        content: 原始内容
+        references: 要应用的 ImageReference 列表（需按位置排序）
+    Returns:
+        new_content: 替换后的内容
+    """
+    parts = []
+    last_end = 0
+    for ref in references:
+        parts.append(content[last_end : ref.start])
+        parts.append(ref.new_path)
+        last_end = ref.end
+    parts.append(content[last_end:])
+    return "".join(parts)
+
+
+def print_image_reference(ref):
+    """显示一处待替换的图片引用"""
+    print(f"\n[{ref.ref_type}] 发现图片引用:")
+    if ref.ref_type == "srcset":
+        print(f"添加响应式图片属性:{ref.new_path}")
+    elif ref.ref_type in DIRECT_REFERENCE_TYPES:
+        before, after = ref.context
+        print(f"上下文：...{before}{Fore.RED}{ref.old_path}{Style.RESET_ALL}{after}...")
+        print(
+            f"替换为：...{before}{Fore.GREEN}{ref.new_path}{Style.RESET_ALL}{after}..."
+        )
+        print(f"{Fore.GREEN}（已确认存在对应的webp文件）{Style.RESET_ALL}")
+    else:
+        print(f"原始引用: {ref.old_path}")
+        print(f"替换为: {ref.new_path}")
+
+
+def ask_replace_direct(example):
+    """展示一处直接引用示例并询问是否替换这类引用
+    Args:
+        example: 作为示例的 ImageReference
+    Returns:
+        (是否替换直接引用, 是否需要逐个确认)
+    """
+    print(
+        f"\n{Fore.YELLOW}发现直接引用或Hugo Shortcode中的图片路径，这种情况需要特别注意！{Style.RESET_ALL}"
+    )
+    print(
+        f"\n{Fore.YELLOW}注意：只有当文件夹中存在对应的webp文件时，才会进行替换。{Style.RESET_ALL}"
+    )
+    print(
+        f"{Fore.YELLOW}例如：如果文中有 555.jpg 这样的假装有表情包的表达，但文件夹中没有 555.webp ，则不会被替换。{Style.RESET_ALL}"
+    )
+    print("\n这些引用可能出现在文本中或Hugo Shortcode中，例如：")
+
+    # 示例
+    before, after = example.context
+    print(f"\n类型：{example.ref_type}")
+    print(
+        f"上下文示例：...{before}{Fore.RED}{example.old_path}{Style.RESET_ALL}{after}..."
+    )
+    print(
+        f"将替换为：...{before}{Fore.GREEN}{example.new_path}{Style.RESET_ALL}{after}..."
+    )
+    print(f"{Fore.GREEN}（已确认存在对应的webp文件）{Style.RESET_ALL}")
+
+    response = input("\n是否要替换这些图片路径？(y/n): ").strip().lower()
+    if response != "y":
+        return False, False
+    # 保险
+    confirm_response = input("是否要逐个确认这些替换？(y/n): ").strip().lower()
+    return True, confirm_response == "y"
+
+
+def confirm_each_reference(references, need_confirm=True, verbose=True):
+    """逐个确认替换，输入 gg 后切换为自动替换
+    Args:
+        references: 待确认的引用
+        need_confirm: 是否需要逐个确认替换
+        verbose: 自动替换时是否逐个显示
+    Returns:
+        (确认替换的引用列表, 之后是否仍需逐个确认)
+    """
+    accepted = []
+    for ref in references:
+        if need_confirm or verbose:
+            print_image_reference(ref)
+        if need_confirm:
+            response = input("是否替换？(y/n/gg，默认n): ").strip().lower()
+            if response == "gg":
+                need_confirm = False
+                accepted.append(ref)
+                print(f"{Fore.YELLOW}切换到自动替换模式{Style.RESET_ALL}")
+            elif response == "y":
+                accepted.append(ref)
+        else:
+            # 自动批处理模式，直接替换
+            accepted.append(ref)
+            if verbose:
+                print(f"{Fore.GREEN}已自动替换{Style.RESET_ALL}")
+    return accepted, need_confirm
+
+
+def without_direct_references(references):
+    """去掉直接引用和Imgrow中的图片"""
+    return [r for r in references if r.ref_type not in DIRECT_REFERENCE_TYPES]
+
+
+def confirm_image_references(references, need_confirm=True, replace_direct=None):
+    """确认要应用的替换
+    Args:
+        references: find_image_references 找到的引用
+        need_confirm: 是否需要逐个确认替换
+        replace_direct: 是否替换直接引用和Imgrow中的图片，None 表示展示示例后询问
+    Returns:
+        accepted: 确认替换的引用列表
+    """
+    direct_refs = [r for r in references if r.ref_type in DIRECT_REFERENCE_TYPES]
+
+    # 如果不需要逐个确认且有直接引用，先显示示例
+    if direct_refs and replace_direct is None and not need_confirm:
+        replace_direct, need_confirm = ask_replace_direct(direct_refs[0])
+    if direct_refs and replace_direct is False:
+        # 移除所有直接引用的替换
+        references = without_direct_references(references)
+
+    if references:
+        print("\n发现以下可替换项：")
+    accepted, _ = confirm_each_reference(references, need_confirm)
+    return accepted
+
+
+def replace_image_references(
+    markdown_path, need_confirm=True, replace_direct=None, webp_index=None, srcset=False
+):
+    """替换Markdown文件中的图片引用为webp格式
+    Args:
+        markdown_path: Markdown文件路径
+        need_confirm: 是否需要逐个确认替换
+        replace_direct: 是否替换直接引用和Imgrow中的图片，None 表示展示示例后询问
+        webp_index: 已建立的 WebpIndex，默认直接检查文件是否存在
+        srcset: 是否为 <img> 补充响应式图片的 srcset（需要 webp_index）
+    """
+    try:
+        with open(markdown_path, "r", encoding="utf-8") as f:
+            content = f.read()
+
+        find_output = webp_index.output_for if webp_index else existing_output
+        references = find_image_references(
+            content,
+            os.path.dirname(markdown_path),
+            find_output,
+            webp_index.srcset_variants if webp_index and srcset else None,
+        )
+        if not references:
+            return False
+
+        print(f"\n处理文件: {markdown_path}")
+        accepted = confirm_image_references(references, need_confirm, replace_direct)
+        if not accepted:
+            return False
+
+        # 如果有任何修改，保存文件
+        write_text_file(markdown_path, apply_image_references(content, accepted))
+        return True
     except Exception as e:
         print(f"处理Markdown文件 {markdown_path} 时出错: {str(e)}")
         return False
 
 
+def read_text_file(file_path):
+    with open(file_path, "r", encoding="utf-8") as f:
+        return f.read()
+
+
+def write_text_file(file_path, content):
+    """原子写入文本文件，中断时文章要么是旧内容要么是新内容"""
+    write_atomic(file_path, content, keep_mode=True)
+
+
+_worker_webp_index = None
+
+
+def _init_analysis_worker(webp_index):
+    """分析进程的初始化函数，每个进程只接收一次webp索引"""
+    global _worker_webp_index
+    _worker_webp_index = webp_index
+
+
+def _analyze_markdown(job):
+    """在子进程中查找一个Markdown文件里可替换的图片引用
+    Args:
+        job: (Markdown文件路径, 文件内容, 是否补充 srcset)
+    Returns:
+        (Markdown文件路径, 引用列表, 错误信息)
+    """
+    markdown_path, content, srcset = job
+    try:
+        references = find_image_references(
+            content,
+            os.path.dirname(markdown_path),
+            _worker_webp_index.output_for,
+            _worker_webp_index.srcset_variants if srcset else None,
+        )
+        return markdown_path, references, None
+    except Exception as e:
+        return markdown_path, [], str(e)
+
+
+def plan_markdown_rewrites(markdown_files, webp_index, workers=None, srcset=False):
+    """并发读取并分析所有Markdown文件，汇总出替换计划
+    Args:
+        markdown_files: Markdown文件列表
+        webp_index: 已建立的 WebpIndex
+        workers: 并行数，默认为CPU核心数
+        srcset: 是否为 <img> 补充响应式图片的 srcset
+    Returns:
+        plan: [(Markdown文件路径, 文件内容, 引用列表)]，只包含有可替换引用的文件
+    """
+    workers = workers or os.cpu_count() or 1
+
+    # 读文件是I/O密集，用线程池
+    contents = {}
+    with ThreadPoolExecutor(max_workers=workers * 2) as executor:
+        future_to_path = {
+            executor.submit(read_text_file, path): path for path in markdown_files
+        }
+        for future in as_completed(future_to_path):
+            path = future_to_path[future]
+            try:
+                contents[path] = future.result()
+            except Exception as e:
+                print(f"读取Markdown文件 {path} 时出错: {str(e)}")
+
+    # 正则分析是CPU密集，用进程池
+    jobs = [
+        (path, contents[path], srcset) for path in markdown_files if path in contents
+    ]
+    if workers <= 1 or len(jobs) <= 1:
+        _init_analysis_worker(webp_index)
+        results = map(_analyze_markdown, jobs)
+        executor = None
+    else:
+        executor = ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_init_analysis_worker,
+            initargs=(webp_index,),
+        )
+        results = executor.map(
+            _analyze_markdown, jobs, chunksize=max(1, len(jobs) // (workers * 4))
+        )
+
+    plan = []
+    try:
+        for markdown_path, references, error in results:
+            if error:
+                print(f"处理Markdown文件 {markdown_path} 时出错: {error}")
+            elif references:
+                plan.append((markdown_path, contents[markdown_path], references))
+    finally:
+        if executor:
+            executor.shutdown()
+    return plan
+
+
+def review_rewrite_plan(plan, need_confirm=False, replace_direct=True):
+    """在写入任何文件之前一次性确认所有替换
+    Args:
+        plan: plan_markdown_rewrites 返回的替换计划
+        need_confirm: 是否需要逐个确认替换
+        replace_direct: 是否替换直接引用，None 表示展示示例后询问
+    Returns:
+        approved: [(Markdown文件路径, 文件内容, 确认替换的引用列表)]
+    """
+    ref_count = sum(len(references) for _, _, references in plan)
+    direct_refs = [
+        ref
+        for _, _, references in plan
+        for ref in references
+        if ref.ref_type in DIRECT_REFERENCE_TYPES
+    ]
+    print(f"\n在 {len(plan)} 个Markdown文件中发现 {ref_count} 处可替换的图片引用")
+    if direct_refs:
+        print(f"其中直接引用或Hugo Imgrow内图片 {len(direct_refs)} 处")
+
+    # 直接引用只询问一次，而不是每个文件都问
+    if direct_refs and replace_direct is None and not need_confirm:
+        replace_direct, need_confirm = ask_replace_direct(direct_refs[0])
+
+    approved = []
+    for markdown_path, content, references in plan:
+        if replace_direct is False:
+            references = without_direct_references(references)
+        if not references:
+            continue
+        if need_confirm:
+            print(f"\n处理文件: {markdown_path}")
+        accepted, need_confirm = confirm_each_reference(
+            references, need_confirm, verbose=False
+        )
+        if accepted:
+            approved.append((markdown_path, content, accepted))
+    return approved
+
+
+def apply_rewrite_plan(approved, workers=None, journal=None, progress=None):
+    """并发写入确认后的替换
+    Args:
+        approved: review_rewrite_plan 返回的结果
+        workers: 并行数，默认为CPU核心数
+        journal: RunJournal，提供时逐个记录写入完成的文件
+        progress: ProgressReporter，提供时每写完一个文件推进一次
+    Returns:
+        updated_files: 成功更新的文件列表
+    """
+    workers = workers or os.cpu_count() or 1
+
+    def write_one(item):
+        markdown_path, content, references = item
+        write_text_file(markdown_path, apply_image_references(content, references))
+        return markdown_path
+
+    updated_files = []
+    with ThreadPoolExecutor(max_workers=workers * 2) as executor:
+        futures = {executor.submit(write_one, item): item[0] for item in approved}
+        for future in as_completed(futures):
+            try:
+                updated_files.append(future.result())
+                if journal:
+                    journal.done("rewrite", updated_files[-1])
+                if progress:
+                    progress.detail(f"已更新: {updated_files[-1]}")
+            except Exception as e:
+                message = f"写入Markdown文件 {futures[future]} 时出错: {str(e)}"
+                if progress:
+                    progress.warn(message)
+                else:
+                    print(message)
+            if progress:
+                progress.advance()
+    return updated_files
+
+
+def file_hash(file_path, chunk_size=1024 * 1024):
+    """计算文件内容的sha256"""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ConversionManifest:
+    """转换记录清单，保存在站点目录下，用于增量转换
+
+    每行一个 JSON 记录，包含源文件相对路径、大小、修改时间、内容哈希和编码参数，
+    同一文件的新记录会覆盖旧记录，save() 时再压缩成每个文件一行。
+    """
+
+    def __init__(self, folder_path):
+        self.folder_path = folder_path
+        self.path = os.path.join(folder_path, MANIFEST_NAME)
+        self.entries = {}
+        self.load()
+
+    def _key(self, image_path):
+        return os.path.relpath(image_path, self.folder_path).replace(os.sep, "/")
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # 上次中断时可能留下半行，忽略即可
+                        continue
+                    self.entries[entry["source"]] = entry
+        except OSError as e:
+            print(
+                f"{Fore.YELLOW}读取转换记录 {self.path} 失败: {str(e)}{Style.RESET_ALL}"
+            )
+
+    def is_tracked(self, image_path):
+        """输出文件是否由本工具生成过"""
+        return self._key(image_path) in self.entries
+
+    def is_up_to_date(
+        self, image_path, settings, output_exists=os.path.exists, stat=os.stat
+    ):
+        """源文件和编码参数都未变化且输出仍存在时返回True"""
+        entry = self.entries.get(self._key(image_path))
+        if not entry or entry.get("settings") != settings:
+            return False
+        # 上次决定保留原图时不会有输出文件，多格式转换时检查选出的输出
+        output_path = (
+            os.path.join(self.folder_path, entry["output"])
+            if entry.get("output")
+            else webp_output_path(image_path)
+        )
+        if not entry.get("kept_original") and not output_exists(output_path):
+            return False
+        try:
+            file_stat = stat(image_path)
+        except OSError:
+            return False
+        if file_stat.st_size != entry["size"]:
+            return False
+        if file_stat.st_mtime_ns == entry["mtime_ns"]:
+            return True
+        # 修改时间变了（例如重新 clone），内容没变也算未变化
+        if file_hash(image_path) == entry["hash"]:
+            # 保留保留原图、实际质量、选出的格式等转换结果
+            details = {
+                key: value
+                for key, value in entry.items()
+                if key not in ("source", "size", "mtime_ns", "hash", "settings")
+            }
+            self.record(image_path, settings, entry["hash"], details)
+            return True
+        return False
+
+    def record(self, image_path, settings, content_hash=None, details=None):
+        """追加一条转换记录
+        Args:
+            image_path: 图片路径
+            settings: 使用的编码参数
+            content_hash: 源文件的sha256，未提供时重新计算
+            details: 额外记录的转换结果，如实际使用的质量
+        """
+        stat = os.stat(image_path)
+        entry = {
+            "source": self._key(image_path),
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "hash": content_hash or file_hash(image_path),
+            "settings": settings,
+        }
+        entry.update(details or {})
+        self.entries[entry["source"]] = entry
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+    def save(self):
+        """压缩记录文件，每个源文件只保留最新一条"""
+        write_atomic(
+            self.path,
+            "".join(
+                json.dumps(entry, ensure_ascii=False) + "\n"
+                for entry in self.entries.values()
+            ),
+        )
+
+
+class RunJournal:
+    """运行日志，记录一次运行中已完成的工作，被中断后可以从断点继续
+
+    保存在站点目录下，每行一个 JSON 事件，写入后立即刷新，进程被杀死时已写入的记录也不会丢失：
+    start 记录命令和备份位置，phase 记录阶段开始时的参数，queued 记录即将开始写入的文件，
+    done 记录完成的文件。
+    运行正常结束后删除。
+    """
+
+    def __init__(self, folder_path):
+        self.folder_path = folder_path
+        self.path = os.path.join(folder_path, JOURNAL_NAME)
+        self.run = None
+        self.phases = {}
+        self._file = None
+        self._lock = threading.Lock()
+        self.load()
+
+    def _key(self, path):
+        return os.path.relpath(path, self.folder_path).replace(os.sep, "/")
+
+    def load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        self._apply(json.loads(line))
+                    except ValueError:
+                        # 被杀死时可能留下半行，忽略即可
+                        continue
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print(
+                f"{Fore.YELLOW}读取运行日志 {self.path} 失败: {str(e)}{Style.RESET_ALL}"
+            )
+
+    def _apply(self, event):
+        if event["event"] == "start":
+            self.run = event
+            self.phases = {}
+        elif event["event"] == "phase":
+            self.phases[event["phase"]] = {
+                "settings": event.get("settings"),
+                "queued": set(),
+                "done": set(),
+            }
+        elif event["event"] == "queued" and event["phase"] in self.phases:
+            self.phases[event["phase"]]["queued"].update(event["items"])
+        elif event["event"] == "done" and event["phase"] in self.phases:
+            self.phases[event["phase"]]["done"].add(event["item"])
+
+    def _write(self, event):
+        with self._lock:
+            self._apply(event)
+            self._file.write(json.dumps(event, ensure_ascii=False) + "\n")
+            self._file.flush()
+
+    def can_resume(self, command):
+        """是否有同一命令未完成的运行"""
+        return self.run is not None and self.run["command"] == command
+
+    def start(self, command, backup_path=None):
+        """开始新的运行，丢弃旧的记录"""
+        self._file = open(self.path, "w", encoding="utf-8")
+        self._write(
+            {
+                "event": "start",
+                "command": command,
+                "backup": backup_path,
+                "created": datetime.now().isoformat(timespec="seconds"),
+            }
+        )
+
+    def resume(self):
+        """继续上次的运行，新的记录追加在后面"""
+        self._file = open(self.path, "a", encoding="utf-8")
+
+    def begin_phase(self, phase, settings=None):
+        """开始一个阶段，参数与中断前相同时沿用已完成的记录
+        Returns:
+            resumed_count: 中断前已完成、本次可以跳过的文件数量
+        """
+        previous = self.phases.get(phase)
+        if previous is not None and previous["settings"] == settings:
+            return len(previous["done"])
+        if previous is not None:
+            print(
+                f"{Fore.YELLOW}参数与中断前不同，{phase} 阶段将从头开始{Style.RESET_ALL}"
+            )
+        self._write({"event": "phase", "phase": phase, "settings": settings})
+        return 0
+
+    def is_done(self, phase, path):
+        previous = self.phases.get(phase)
+        return previous is not None and self._key(path) in previous["done"]
+
+    def was_queued(self, phase, path):
+        """中断前是否已开始处理，这些文件可能已经写出了一部分输出"""
+        previous = self.phases.get(phase)
+        return previous is not None and self._key(path) in previous["queued"]
+
+    def queue(self, phase, paths):
+        """在开始写入之前记录要处理的文件"""
+        self._write(
+            {
+                "event": "queued",
+                "phase": phase,
+                "items": [self._key(path) for path in paths],
+            }
+        )
+
+    def done(self, phase, path):
+        """记录一个已完成的文件，可在多个线程中调用"""
+        self._write({"event": "done", "phase": phase, "item": self._key(path)})
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def finish(self):
+        """运行正常结束，删除运行日志"""
+        self.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+        self.run = None
+        self.phases = {}
+
+
+def webp_output_path(image_path):
+    """图片对应的webp输出路径"""
+    return os.path.splitext(image_path)[0] + ".webp"
+
+
+def avif_output_path(webp_path):
+    """多格式转换时与webp同名的 avif 输出路径"""
+    return os.path.splitext(webp_path)[0] + ".avif"
+
+
+def responsive_webp_path(webp_path, width):
+    """响应式图片的路径，如 a.webp -> a-480w.webp"""
+    return f"{os.path.splitext(webp_path)[0]}-{width}w.webp"
+
+
+def encoder_settings(
+    lossless=False,
+    quality=80,
+    max_dimension=None,
+    widths=None,
+    target=None,
+    auto_classify=False,
+    metadata="strip",
+    formats=None,
+    keep="smallest",
+    avif_quality=None,
+):
+    """生成编码参数，既传给 encode_webp 也写入转换记录
+    Args:
+        target: 自适应质量的目标，如 {"type": "bytes", "value": 200000}，
+            type 可为 bytes（字节上限）、ratio（相对原图的体积比例）、
+            similarity（与原图的最低相似度，0-1）
+        auto_classify: 是否按图片内容自动选择无损、近无损或有损
+        metadata: 元数据策略，见 METADATA_POLICIES
+        formats: 多格式转换的候选格式，默认只生成webp
+        keep: 多格式转换时保留最小的结果还是全部结果
+        avif_quality: avif 的压缩质量，默认由 quality 推算
+    """
+    if auto_classify:
+        lossless = False
+    settings = {"lossless": bool(lossless), "quality": None if lossless else quality}
+    if auto_classify:
+        settings["auto_classify"] = True
+    # 未启用的参数不写入，旧的转换记录仍然有效
+    if max_dimension:
+        settings["max_dimension"] = max_dimension
+    if widths:
+        settings["widths"] = sorted(set(widths), reverse=True)
+    if target and not lossless:
+        settings["target"] = target
+    if metadata != "strip":
+        settings["metadata"] = metadata
+    if formats:
+        settings["formats"] = [name for name in OUTPUT_FORMATS if name in formats]
+        if keep != "smallest":
+            settings["keep"] = keep
+        if avif_quality and "avif" in formats:
+            settings["avif_quality"] = avif_quality
+    return settings
+
+
+def encode_to_bytes(image, image_format="webp", **save_options):
+    """在内存中编码，默认为webp"""
+    buffer = io.BytesIO()
+    image.save(buffer, image_format, **save_options)
+    return buffer.getvalue()
+
+
+def image_similarity(reference, candidate, max_side=1024):
+    """用 numpy 计算两张图片的分块 SSIM（8×8 块），返回 0-1 之间的相似度"""
+    if np is None:
+        raise RuntimeError("按相似度搜索质量需要安装 numpy")
+    size = reference.size
+    if max(size) > max_side:
+        scale = max_side / max(size)
+        size = (max(8, round(size[0] * scale)), max(8, round(size[1] * scale)))
+    a = np.asarray(reference.convert("L").resize(size), dtype=np.float64)
+    b = np.asarray(candidate.convert("L").resize(size), dtype=np.float64)
+
+    # 裁成 8 的倍数后按块求均值、方差和协方差
+    height, width = (a.shape[0] // 8) * 8, (a.shape[1] // 8) * 8
+    if height == 0 or width == 0:
+        return 1.0 if np.array_equal(a, b) else 0.0
+    a = a[:height, :width].reshape(height // 8, 8, width // 8, 8)
+    b = b[:height, :width].reshape(height // 8, 8, width // 8, 8)
+    mu_a, mu_b = a.mean(axis=(1, 3)), b.mean(axis=(1, 3))
+    var_a, var_b = a.var(axis=(1, 3)), b.var(axis=(1, 3))
+    cov = (a * b).mean(axis=(1, 3)) - mu_a * mu_b
+    c1, c2 = (0.01 * 255) ** 2, (0.03 * 255) ** 2
+    ssim = ((2 * mu_a * mu_b + c1) * (2 * cov + c2)) / (
+        (mu_a**2 + mu_b**2 + c1) * (var_a + var_b + c2)
+    )
+    return float(ssim.mean())
+
+
+def pixel_difference(reference, candidate, max_side=1024):
+    """用 numpy 计算两张图片 RGBA 各通道的平均绝对差（0-255），尺寸不同时缩放到一致"""
+    if np is None:
+        raise RuntimeError("按像素差异校验需要安装 numpy")
+    size = reference.size
+    if max(size) > max_side:
+        scale = max_side / max(size)
+        size = (max(1, round(size[0] * scale)), max(1, round(size[1] * scale)))
+    a = np.asarray(reference.convert("RGBA").resize(size), dtype=np.int16)
+    b = np.asarray(candidate.convert("RGBA").resize(size), dtype=np.int16)
+    return float(np.abs(a - b).mean())
+
+
+def search_quality(image, target, original_size, extra_options=None):
+    """二分搜索满足目标的压缩质量
+    Args:
+        image: 已解码的图片
+        target: encoder_settings 中的 target
+        original_size: 原图文件大小
+        extra_options: 额外的保存参数（如保留的元数据），搜索时一并写入，大小按最终文件计算
+    Returns:
+        (质量, 编码后的数据)
+    """
+    cache = {}
+
+    def encode(quality):
+        if quality not in cache:
+            cache[quality] = encode_to_bytes(
+                image, quality=quality, **(extra_options or {})
+            )
+        return cache[quality]
+
+    if target["type"] == "similarity":
+        # 找满足相似度的最低质量
+        def satisfied(quality):
+            with Image.open(io.BytesIO(encode(quality))) as candidate:
+                return image_similarity(image, candidate) >= target["value"]
+
+        low, high, best = 1, 100, 100
+        while low <= high:
+            middle = (low + high) // 2
+            if satisfied(middle):
+                best, high = middle, middle - 1
+            else:
+                low = middle + 1
+        return best, encode(best)
+
+    # 字节预算：找不超过预算的最高质量，都超过时用最低质量
+    if target["type"] == "ratio":
+        budget = original_size * target["value"]
+    else:
+        budget = target["value"]
+    low, high, best = 1, 100, 1
+    while low <= high:
+        middle = (low + high) // 2
+        if len(encode(middle)) <= budget:
+            best, low = middle, middle + 1
+        else:
+            high = middle - 1
+    return best, encode(best)
+
+
+def classify_image(image, sample_size=256):
+    """根据缩小后的图片快速判断内容类型
+    Args:
+        image: 已打开的图片
+        sample_size: 分析用缩略图的最长边
+    Returns:
+        (类型, 特征)，类型为 "lossless"（图标、图表等少色图）、
+        "near_lossless"（截图、文字等大面积纯色加锐利边缘）或 "lossy"（照片）
+    """
+    if np is None:
+        raise RuntimeError("自动判断压缩方式需要安装 numpy")
+    sample = image.copy()
+    # 最近邻缩放不会混出新的颜色，颜色数才有意义
+    sample.thumbnail((sample_size, sample_size), Image.Resampling.NEAREST)
+    has_alpha = "A" in sample.getbands() or "transparency" in sample.info
+    sample = sample.convert("RGBA")
+    pixels = np.asarray(sample, dtype=np.uint32)
+
+    rgb = (pixels[..., 0] << 16) | (pixels[..., 1] << 8) | pixels[..., 2]
+    color_count = int(np.unique(rgb).size)
+    alpha = pixels[..., 3]
+    alpha_ratio = float((alpha < 255).mean()) if has_alpha else 0.0
+
+    gray = np.asarray(sample.convert("L"), dtype=np.int16)
+    grad_x = np.abs(np.diff(gray, axis=1))
+    grad_y = np.abs(np.diff(gray, axis=0))
+    # 相邻像素完全相同的比例（大面积纯色）和强边缘的比例
+    flat_ratio = float(((grad_x == 0).mean() + (grad_y == 0).mean()) / 2)
+    edge_ratio = float(((grad_x > 48).mean() + (grad_y > 48).mean()) / 2)
+
+    features = {
+        "colors": color_count,
+        "alpha": round(alpha_ratio, 3),
+        "flat": round(flat_ratio, 3),
+        "edges": round(edge_ratio, 3),
+    }
+    if color_count <= 256 or (alpha_ratio > 0 and color_count <= 1024):
+        return "lossless", features
+    if flat_ratio > 0.5 and edge_ratio > 0.02:
+        return "near_lossless", features
+    return "lossy", features
+
+
+def write_atomic(path, data, keep_mode=False):
+    """先写入同目录下的临时文件再重命名，中断时不会留下写了一半的文件
+
+    重命名替换的是目录项，与其他文件共用硬链接时也不会改动到另一份
+    Args:
+        path: 目标路径
+        data: bytes，或按 UTF-8 写入的 str
+        keep_mode: 目标已存在时是否沿用它的权限
+    """
+    tmp_path = temp_path(path)
+    try:
+        if isinstance(data, str):
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(data)
+        else:
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+        if keep_mode:
+            try:
+                shutil.copymode(path, tmp_path)
+            except FileNotFoundError:
+                pass
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def remove_stale_temp_files(directories):
+    """删除被中断的进程留下的临时文件，仍在运行的进程的临时文件不动
+    Args:
+        directories: 要检查的目录
+    Returns:
+        removed_count: 删除的文件数量
+    """
+    removed_count = 0
+    for directory in set(directories):
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            continue
+        for name in names:
+            match = TEMP_FILE_PATTERN.search(name)
+            if not match:
+                continue
+            try:
+                os.kill(int(match.group(1)), 0)
+                continue
+            except ProcessLookupError:
+                pass
+            except OSError:
+                # 没有权限发信号说明进程还在
+                continue
+            try:
+                os.remove(os.path.join(directory, name))
+                removed_count += 1
+            except OSError:
+                pass
+    return removed_count
+
+
+def write_outputs(payloads):
+    """依次原子写入编码结果
+    Args:
+        payloads: [(输出路径, webp数据)]
+    """
+    for output_path, data in payloads:
+        write_atomic(output_path, data)
+
+
+def metadata_options(image, metadata="strip"):
+    """按元数据策略生成保存参数，并统计被去除的元数据大小
+    Returns:
+        (save_options, stripped_bytes)
+    """
+    blobs = {
+        "icc_profile": image.info.get("icc_profile"),
+        "exif": image.info.get("exif"),
+        "xmp": image.info.get("xmp") or image.info.get("XML:com.adobe.xmp"),
+    }
+    kept = {"strip": (), "icc": ("icc_profile",), "all": tuple(blobs)}[metadata]
+    save_options = {}
+    stripped_bytes = 0
+    for key, blob in blobs.items():
+        if not blob:
+            continue
+        if key in kept:
+            save_options[key] = blob
+        else:
+            stripped_bytes += len(blob)
+    return save_options, stripped_bytes
+
+
+def encode_animated_webp(image, lossless=False, quality=80, extra_options=None):
+    """把 GIF/APNG 动图编码为webp动图，保留每帧的时长和循环次数
+
+    先逐帧读取时长，再由 Pillow 逐帧解码、编码，任何时候内存中只有一帧。
+    """
+    # GIF 没有循环扩展时只播放一次
+    loop = image.info.get("loop", 1)
+    durations = []
+    for index in range(image.n_frames):
+        image.seek(index)
+        durations.append(round(image.info.get("duration", 0)))
+    image.seek(0)
+    save_options = {"lossless": True} if lossless else {"quality": quality}
+    save_options.update(extra_options or {})
+    return encode_to_bytes(
+        image, save_all=True, duration=durations, loop=loop, **save_options
+    )
+
+
+def encode_webp_data(
+    source,
+    output_path,
+    original_size,
+    lossless=False,
+    quality=80,
+    max_dimension=None,
+    widths=None,
+    target=None,
+    auto_classify=False,
+    metadata="strip",
+    formats=None,
+    keep="smallest",
+    avif_quality=None,
+):
+    """在内存中完成webp编码，不写任何文件，出错时直接抛出异常
+    Args:
+        source: 图片路径或已读入内存的文件对象
+        output_path: 输出的webp路径，用于确定响应式版本的文件名
+        original_size: 原图字节数，自适应质量时用于判断是否保留原图
+        其余参数见 encode_webp
+    Returns:
+        (info, payloads): info 见 encode_webp；payloads 为 [(输出路径, webp数据)]
+    """
+    info = {
+        "outputs": [],
+        "quality": None,
+        "content_class": None,
+        "features": None,
+        "timings": {},
+    }
+    payloads = []
+
+    # 用 with 确保文件句柄和解码缓冲及时释放
+    start = time.perf_counter()
+    with Image.open(source) as image:
+        if getattr(image, "is_animated", False):
+            # 动图不缩放、不生成响应式版本，webp没有更小时保留原图
+            extra_options, info["metadata_stripped"] = metadata_options(image, metadata)
+            data = encode_animated_webp(image, lossless, quality, extra_options)
+            info["frames"] = image.n_frames
+            info["timings"]["encode_ms"] = (time.perf_counter() - start) * 1000
+            if len(data) >= original_size:
+                return info, payloads
+            info["quality"] = None if lossless else quality
+            info["outputs"].append(output_path)
+            payloads.append((output_path, data))
+            return info, payloads
+
+        shrink = max_dimension and max(image.size) > max_dimension
+        if shrink and image.format == "JPEG":
+            # JPEG 可以直接按 1/2、1/4、1/8 的比例解码，不必先解出原图
+            image.draft(image.mode, jpeg_draft_box(image.size, max_dimension))
+        # 按 EXIF 方向旋转像素，同时去掉 EXIF 中的方向标记
+        ImageOps.exif_transpose(image, in_place=True)
+        extra_options, info["metadata_stripped"] = metadata_options(image, metadata)
+        if shrink:
+            image.thumbnail((max_dimension, max_dimension), reducing_gap=2.0)
+        image.load()
+        decoded = time.perf_counter()
+        info["timings"]["decode_ms"] = (decoded - start) * 1000
+
+        if auto_classify:
+            content_class, info["features"] = classify_image(image)
+            info["content_class"] = content_class
+            if content_class == "lossless":
+                lossless = True
+            elif content_class == "near_lossless":
+                quality = max(quality or 0, NEAR_LOSSLESS_QUALITY)
+                # 截图类图片的质量已确定，不再搜索
+                target = None
+
+        # 同一次解码编码出所有候选格式：[(格式, 输出路径, 数据)]
+        candidates = []
+        save_options = {"lossless": True} if lossless else {"quality": quality}
+        if not formats or "webp" in formats:
+            if target and not lossless:
+                # 在内存中搜索质量，只保留最终结果
+                quality, data = search_quality(
+                    image, target, original_size, extra_options
+                )
+                info["quality"] = quality
+                if len(data) >= original_size and not formats:
+                    info["timings"]["encode_ms"] = (
+                        time.perf_counter() - decoded
+                    ) * 1000
+                    return info, payloads
+                save_options = {"quality": quality}
+            else:
+                data = encode_to_bytes(image, **save_options, **extra_options)
+            candidates.append(("webp", output_path, data))
+        # 已经按无损编码过webp时不必重复
+        if (
+            formats
+            and "webp-lossless" in formats
+            and not (lossless and "webp" in formats)
+        ):
+            data = encode_to_bytes(image, lossless=True, **extra_options)
+            candidates.append(("webp-lossless", output_path, data))
+        if formats and "avif" in formats:
+            avif_quality = avif_quality or max(
+                1, (quality or DEFAULT_QUALITY) - AVIF_QUALITY_OFFSET
+            )
+            # Pillow 的 avif 编码器没有传 icc_profile 时会沿用原图的 ICC，需要显式去除
+            avif_options = {"icc_profile": b"", **extra_options}
+            data = encode_to_bytes(image, "avif", quality=avif_quality, **avif_options)
+            candidates.append(("avif", avif_output_path(output_path), data))
+
+        # 同一路径只保留较小的webp，最小的结果排在最前，作为引用指向的输出
+        by_path = {}
+        for name, path, data in candidates:
+            if path not in by_path or len(data) < len(by_path[path][1]):
+                by_path[path] = (name, data)
+        ranked = sorted(by_path.items(), key=lambda item: len(item[1][1]))
+        if keep != "all":
+            ranked = ranked[:1]
+        chosen, chosen_data = ranked[0][1]
+        if formats:
+            info["format"] = chosen
+            if target and len(chosen_data) >= original_size:
+                # 所有格式都没有更小，保留原图
+                info["timings"]["encode_ms"] = (time.perf_counter() - decoded) * 1000
+                return info, payloads
+        if chosen == "webp-lossless":
+            info["quality"] = None
+        elif chosen == "avif":
+            info["quality"] = avif_quality
+        else:
+            info["quality"] = save_options.get("quality")
+        for path, (name, data) in ranked:
+            info["outputs"].append(path)
+            payloads.append((path, data))
+
+        # 响应式版本总是webp，沿用候选中webp的编码方式
+        if output_path in by_path and by_path[output_path][0] == "webp-lossless":
+            save_options = {"lossless": True}
+        save_options.update(extra_options)
+
+        # 只解码一次，从大到小逐级缩放，每一级都基于上一级的结果
+        current = image
+        for width in sorted(widths or (), reverse=True):
+            if width >= current.width:
+                continue
+            height = max(1, round(current.height * width / current.width))
+            current = current.resize(
+                (width, height), Image.Resampling.LANCZOS, reducing_gap=2.0
+            )
+            variant_path = responsive_webp_path(output_path, width)
+            info["outputs"].append(variant_path)
+            payloads.append((variant_path, encode_to_bytes(current, **save_options)))
+    info["timings"]["encode_ms"] = (time.perf_counter() - decoded) * 1000
+    return info, payloads
+
+
+def encode_webp(
+    image_path,
+    output_path,
+    lossless=False,
+    quality=80,
+    max_dimension=None,
+    widths=None,
+    target=None,
+    auto_classify=False,
+    metadata="strip",
+    formats=None,
+    keep="smallest",
+    avif_quality=None,
+):
+    """执行实际的webp编码并原子写入所有输出，出错时直接抛出异常
+    Args:
+        image_path: 图片路径
+        output_path: 输出的webp路径
+        lossless: 是否使用无损压缩
+        quality: 压缩质量(1-100)
+        max_dimension: 输出的最长边，超过时等比缩小
+        widths: 额外生成的响应式宽度，只生成比原图窄的版本
+        target: 自适应质量的目标，见 encoder_settings；
+            启用时若webp不比原图小则不写出任何文件
+        auto_classify: 是否按图片内容自动选择无损、近无损或有损
+            （动图只按 lossless 和 quality 编码，webp不比原图小时同样不写出）
+        metadata: 元数据策略，见 METADATA_POLICIES；EXIF 方向总是先应用到像素上
+        formats: 多格式转换的候选格式，见 OUTPUT_FORMATS，"webp" 即按上面的参数编码的webp；
+            同一次解码编码出所有格式，动图和响应式版本仍只生成webp
+        keep: 多格式转换时 "smallest" 只保留最小的结果，"all" 全部保留（同名webp只留较小的一个）
+        avif_quality: avif 的压缩质量，默认为 quality 减去 AVIF_QUALITY_OFFSET，
+            无损时用 DEFAULT_QUALITY 推算
+    Returns:
+        info: 包含 outputs（生成的所有webp路径，保留原图时为空）、
+            quality（实际使用的质量，无损时为None）、
+            content_class 和 features（自动判断的结果）、
+            metadata_stripped（去除的元数据字节数）、
+            format（多格式转换时选出的格式，对应 outputs 中的第一个）、
+            timings（decode_ms、encode_ms、write_ms）的字典
+    """
+    info, payloads = encode_webp_data(
+        image_path,
+        output_path,
+        os.path.getsize(image_path),
+        lossless=lossless,
+        quality=quality,
+        max_dimension=max_dimension,
+        widths=widths,
+        target=target,
+        auto_classify=auto_classify,
+        metadata=metadata,
+        formats=formats,
+        keep=keep,
+        avif_quality=avif_quality,
+    )
+    start = time.perf_counter()
+    write_outputs(payloads)
+    info["timings"]["write_ms"] = (time.perf_counter() - start) * 1000
+    return info
+
+
+def jpeg_draft_box(size, max_dimension):
+    """传给 Image.draft 的目标尺寸：与原图同比例、最长边为 max_dimension
+
+    Pillow 取两个方向上整除倍数的较小值作为缩小比例，目标必须与原图同比例，
+    否则非正方形的图片完全不会缩小
+    """
+    width, height = size
+    longest = max(width, height)
+    return -(-width * max_dimension // longest), -(-height * max_dimension // longest)
+
+
+def estimate_decode_memory(image_path, max_dimension=None):
+    """根据图片头信息估算解码需要的内存（宽 × 高 × 通道数）
+    Args:
+        image_path: 图片路径
+        max_dimension: 输出的最长边，JPEG 会以缩小比例解码
+    Returns:
+        memory: 估算的字节数，无法读取时返回0
+    """
+    try:
+        with Image.open(image_path) as image:
+            width, height = image.size
+            bands = len(image.getbands())
+            if max_dimension and image.format == "JPEG":
+                # 与 Image.draft 的计算方式相同：两个方向的较小倍数，取不超过它的 8、4、2、1
+                box = jpeg_draft_box((width, height), max_dimension)
+                ratio = min(width // box[0], height // box[1])
+                scale = next(s for s in (8, 4, 2, 1) if ratio >= s)
+                width, height = -(-width // scale), -(-height // scale)
+            return width * height * bands
+    except Exception:
+        return 0
+
+
 def convert_to_webp(image_path, lossless=False, need_confirm=True, quality=80):
     """将图片转换为webp格式
     Args:
@@ -595,7 +2528,7 @@ def convert_to_webp(image_path, lossless=False, need_confirm=True, quality=80):
     """
     try:
         # 构建输出文件路径
-        output_path = os.path.splitext(image_path)[0] + ".webp"
+        output_path = webp_output_path(image_path)
 
         # 检查是否已存在同名webp文件
         if os.path.exists(output_path):
@@ -612,40 +2545,954 @@ def convert_to_webp(image_path, lossless=False, need_confirm=True, quality=80):
                     return False
 
         # 转换图片
-        image = Image.open(image_path)
-        if lossless:
-            image.save(output_path, "webp", lossless=True)
-        else:
-            image.save(output_path, "webp", quality=quality)
+        encode_webp(image_path, output_path, lossless=lossless, quality=quality)
         return True
     except Exception as e:
         print(f"{Fore.RED}转换 {image_path} 时出错: {str(e)}{Style.RESET_ALL}")
         return False
 
 
-def process_images(folder_path):
+class EncodeCache:
+    """按源文件内容和编码参数寻址的编码结果缓存，跨仓库、跨分支共用
+
+    每个条目是一个目录，保存所有输出文件和 meta.json；
+    命中时更新 meta.json 的修改时间，淘汰时按修改时间从旧到新删除（LRU）。
+    """
+
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir or self.default_dir()
+
+    @staticmethod
+    def default_dir():
+        base = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+            os.path.expanduser("~"), ".cache"
+        )
+        return os.environ.get("BLOG_WEBP_CACHE_DIR") or os.path.join(
+            base, "blog-webp-assistant"
+        )
+
+    @staticmethod
+    def encoder_version():
+        return f"Pillow {PIL.__version__}, libwebp {features.version('webp')}"
+
+    def key(self, source_hash, settings):
+        encoder = self.encoder_version()
+        if "avif" in settings.get("formats", ()):
+            encoder += f", libavif {features.version('avif')}"
+        payload = json.dumps(
+            {
+                "source": source_hash,
+                "settings": settings,
+                "encoder": encoder,
+                "pipeline": ENCODER_PIPELINE_VERSION,
+            },
+            sort_keys=True,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _entry_dir(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def fetch(self, key, output_path):
+        """命中缓存时把输出文件复制到位
+        Returns:
+            info: 与 encode_webp 返回值相同的字典，未命中时返回None
+        """
+        entry_dir = self._entry_dir(key)
+        meta_path = os.path.join(entry_dir, "meta.json")
+        try:
+            with open(meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        stem = os.path.splitext(output_path)[0]
+        outputs = []
+        for suffix in meta["suffixes"]:
+            target_path = stem + suffix
+            # 先复制到临时文件再替换，中断时不会留下半个文件，也不会改动共用硬链接的另一份
+            tmp_path = temp_path(target_path)
+            try:
+                clone_file(os.path.join(entry_dir, "out" + suffix), tmp_path)
+                os.replace(tmp_path, target_path)
+            except BaseException:
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+                raise
+            outputs.append(target_path)
+        os.utime(meta_path)
+        return dict(meta["info"], outputs=outputs)
+
+    def store(self, key, output_path, info):
+        """保存一次编码的全部输出，先写临时目录再重命名，并发写同一条目也安全"""
+        entry_dir = self._entry_dir(key)
+        if os.path.exists(entry_dir):
+            return
+        tmp_dir = f"{entry_dir}.tmp-{os.getpid()}"
+        os.makedirs(tmp_dir, exist_ok=True)
+        try:
+            stem = os.path.splitext(output_path)[0]
+            suffixes = []
+            for path in info["outputs"]:
+                suffix = path[len(stem) :]
+                clone_file(path, os.path.join(tmp_dir, "out" + suffix))
+                suffixes.append(suffix)
+            meta = {
+                "suffixes": suffixes,
+                "info": {
+                    k: v for k, v in info.items() if k not in ("outputs", "timings")
+                },
+            }
+            with open(os.path.join(tmp_dir, "meta.json"), "w", encoding="utf-8") as f:
+                json.dump(meta, f, ensure_ascii=False)
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def _entries(self):
+        """列出所有条目: [(最近使用时间, 大小, 目录)]"""
+        entries = []
+        try:
+            prefixes = os.listdir(self.cache_dir)
+        except OSError:
+            return entries
+        for prefix in prefixes:
+            prefix_dir = os.path.join(self.cache_dir, prefix)
+            try:
+                names = os.listdir(prefix_dir)
+            except OSError:
+                continue
+            for name in names:
+                entry_dir = os.path.join(prefix_dir, name)
+                try:
+                    last_used = os.stat(os.path.join(entry_dir, "meta.json")).st_mtime
+                    size = sum(
+                        entry.stat().st_size
+                        for entry in os.scandir(entry_dir)
+                        if entry.is_file()
+                    )
+                except OSError:
+                    continue
+                entries.append((last_used, size, entry_dir))
+        return entries
+
+    def stats(self):
+        """缓存统计信息"""
+        entries = self._entries()
+        return {
+            "path": self.cache_dir,
+            "entries": len(entries),
+            "bytes": sum(size for _, size, _ in entries),
+            "oldest": min((used for used, _, _ in entries), default=None),
+            "newest": max((used for used, _, _ in entries), default=None),
+        }
+
+    def evict(self, max_bytes):
+        """超过容量上限时删除最久未使用的条目
+        Returns:
+            (删除的条目数, 释放的字节数)
+        """
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        removed_count = 0
+        freed_bytes = 0
+        for _, size, entry_dir in entries:
+            if total <= max_bytes:
+                break
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total -= size
+            removed_count += 1
+            freed_bytes += size
+        return removed_count, freed_bytes
+
+
+def new_convert_result(image_path):
+    """单个文件转换结果的初始值，各种转换方式返回相同结构的字典"""
+    return {
+        "path": image_path,
+        "success": False,
+        "error": None,
+        "hash": None,
+        "outputs": [],
+        "quality": None,
+        "content_class": None,
+        "features": None,
+        "format": None,
+        "metadata_stripped": 0,
+        "cached": False,
+        "timings": {},
+    }
+
+
+def _convert_worker(job):
+    """进程池中执行的单个转换任务，异常不会抛出到主进程
+    Args:
+        job: (图片路径, encoder_settings 生成的编码参数, 缓存目录或None)
+    Returns:
+        result: 包含 path、success、error 和源文件 hash 的字典
+    """
+    image_path, settings, cache_dir = job
+    result = new_convert_result(image_path)
+    try:
+        output_path = webp_output_path(image_path)
+        result["hash"] = file_hash(image_path)
+        cache = EncodeCache(cache_dir) if cache_dir else None
+        info = None
+        if cache:
+            cache_key = cache.key(result["hash"], settings)
+            info = cache.fetch(cache_key, output_path)
+            result["cached"] = info is not None
+        if info is None:
+            info = encode_webp(image_path, output_path, **settings)
+            if cache:
+                cache.store(cache_key, output_path, info)
+        result.update(info)
+        result["success"] = True
+    except Exception as e:
+        result["error"] = str(e)
+    return result
+
+
+class MemoryScheduler:
+    """按估算的解码内存决定何时提交下一个任务
+
+    任务按估算内存从大到小排列，优先放入装得下的最大任务，
+    装不下时再用最小的任务填充剩余空间；没有任务在运行时总会放行一个，
+    保证超过预算的单张大图也能被处理。
+    """
+
+    def __init__(self, jobs, estimates, budget):
+        self.budget = budget
+        self.in_use = 0
+        self.estimates = estimates
+        self.queue = deque(
+            sorted(jobs, key=lambda job: estimates.get(job[0], 0), reverse=True)
+        )
+
+    def __len__(self):
+        return len(self.queue)
+
+    def next_job(self, running):
+        """取出下一个可以提交的任务，当前无法放行时返回None"""
+
+        def fits(job):
+            cost = self.estimates.get(job[0], 0)
+            return running == 0 or self.in_use + cost <= self.budget
+
+        if self.queue and fits(self.queue[0]):
+            job = self.queue.popleft()
+        elif self.queue and fits(self.queue[-1]):
+            job = self.queue.pop()
+        else:
+            return None
+        self.in_use += self.estimates.get(job[0], 0)
+        return job
+
+    def release(self, job):
+        self.in_use -= self.estimates.get(job[0], 0)
+
+
+def find_duplicate_images(image_files, stat=os.stat, workers=None):
+    """找出内容完全相同的图片，先按大小筛选，再计算完整哈希
+    Args:
+        image_files: 图片路径列表
+        stat: 获取文件 stat 的函数
+        workers: 并行计算哈希的线程数
+    Returns:
+        duplicates: {首个出现的图片: [内容相同的其他图片]}
+    """
+    by_size = {}
+    for image_path in image_files:
+        try:
+            by_size.setdefault(stat(image_path).st_size, []).append(image_path)
+        except OSError:
+            continue
+    candidates = [
+        path for paths in by_size.values() if len(paths) > 1 for path in paths
+    ]
+    if not candidates:
+        return {}
+
+    hashes = {}
+    with ThreadPoolExecutor(
+        max_workers=(workers or os.cpu_count() or 1) * 2
+    ) as executor:
+        future_to_path = {executor.submit(file_hash, path): path for path in candidates}
+        for future in as_completed(future_to_path):
+            try:
+                hashes[future_to_path[future]] = future.result()
+            except OSError:
+                pass
+
+    duplicates = {}
+    first_by_hash = {}
+    # 按原始顺序遍历，保证选出的首个图片稳定
+    for image_path in candidates:
+        digest = hashes.get(image_path)
+        if digest is None:
+            continue
+        primary = first_by_hash.setdefault(digest, image_path)
+        if primary != image_path:
+            duplicates.setdefault(primary, []).append(image_path)
+    return duplicates
+
+
+def link_or_copy(src, dst):
+    """优先硬链接，跨设备等无法链接时复制；先写临时文件再替换，不会留下半个文件"""
+    tmp_path = temp_path(dst)
+    try:
+        os.link(src, tmp_path)
+    except OSError:
+        shutil.copyfile(src, tmp_path)
+    os.replace(tmp_path, dst)
+
+
+def replicate_result(result, duplicate_path):
+    """把一张图片的转换结果复用到内容相同的另一张图片
+    Args:
+        result: 已转换图片的结果，见 _convert_worker
+        duplicate_path: 内容相同的图片路径
+    Returns:
+        duplicate_result: 复用后的结果
+    """
+    duplicate_result = dict(result, path=duplicate_path, duplicate_of=result["path"])
+    if not result["success"]:
+        return duplicate_result
+
+    # 按相同的命名规则映射输出路径，如 a.webp -> b.webp、a-480w.webp -> b-480w.webp
+    source_stem = os.path.splitext(result["path"])[0]
+    duplicate_stem = os.path.splitext(duplicate_path)[0]
+    outputs = []
+    try:
+        for output_path in result["outputs"]:
+            duplicate_output = duplicate_stem + output_path[len(source_stem) :]
+            link_or_copy(output_path, duplicate_output)
+            outputs.append(duplicate_output)
+    except OSError as e:
+        duplicate_result.update(success=False, error=str(e))
+    duplicate_result["outputs"] = outputs
+    return duplicate_result
+
+
+def iter_convert_parallel(
+    image_files, settings, workers=None, memory_budget=None, cache_dir=None
+):
+    """使用进程池并行转换图片，按完成顺序逐个返回结果
+    Args:
+        image_files: 要转换的图片路径列表（覆盖与否应在调用前确定）
+        settings: encoder_settings 生成的编码参数
+        workers: 并行进程数，默认为CPU核心数
+        memory_budget: 同时解码的图片估算内存上限（字节），默认不限制
+        cache_dir: 编码缓存目录，默认不使用缓存
+    Yields:
+        result: 每个文件的转换结果，见 _convert_worker
+    """
+    workers = workers or os.cpu_count() or 1
+    jobs = [(image_path, settings, cache_dir) for image_path in image_files]
+
+    # 单进程或只有一个文件时没必要启动进程池
+    if workers <= 1 or len(jobs) <= 1:
+        for job in jobs:
+            yield _convert_worker(job)
+        return
+
+    # 只读取图片头，用线程池并发估算
+    estimates = {}
+    if memory_budget:
+        max_dimension = settings.get("max_dimension")
+        with ThreadPoolExecutor(max_workers=workers * 2) as executor:
+            estimates = dict(
+                zip(
+                    image_files,
+                    executor.map(
+                        lambda path: estimate_decode_memory(path, max_dimension),
+                        image_files,
+                    ),
+                )
+            )
+        budget = memory_budget
+    else:
+        budget = float("inf")
+    scheduler = MemoryScheduler(jobs, estimates, budget)
+
+    # 限制同时提交的任务数量，避免一次性创建几万个 Future
+    max_pending = workers * 2
+    # 工作进程被杀死（内存不足、解码器崩溃）后进程池不能再用，
+    # 正在处理的文件记为失败，剩下的文件换一个新的进程池继续
+    while len(scheduler):
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            pending = {}
+            broken = False
+
+            def fill():
+                while not broken and len(pending) < max_pending:
+                    job = scheduler.next_job(len(pending))
+                    if job is None:
+                        break
+                    pending[executor.submit(_convert_worker, job)] = job
+
+            fill()
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    job = pending.pop(future)
+                    scheduler.release(job)
+                    try:
+                        result = future.result()
+                    except BrokenProcessPool:
+                        broken = True
+                        result = new_convert_result(job[0])
+                        result["error"] = (
+                            "工作进程意外退出（可能是内存不足或解码器崩溃）"
+                        )
+                    except Exception as e:
+                        result = new_convert_result(job[0])
+                        result["error"] = str(e)
+                    yield result
+                fill()
+
+
+def read_source(image_path):
+    """读入整个源文件"""
+    with open(image_path, "rb") as f:
+        return f.read()
+
+
+def _encode_stage(job):
+    """流水线中在进程池执行的编码阶段
+    Args:
+        job: (源文件数据, 图片路径, encoder_settings 生成的编码参数)
+    Returns:
+        (info, payloads): 见 encode_webp_data
+    """
+    data, image_path, settings = job
+    return encode_webp_data(
+        io.BytesIO(data), webp_output_path(image_path), len(data), **settings
+    )
+
+
+class PipelineMetrics:
+    """流式流水线的统计：各阶段累计耗时和队列深度采样"""
+
+    STAGES = ("read", "encode", "write")
+    QUEUES = ("encode", "write")
+
+    def __init__(self, queue_size, concurrency):
+        self.queue_size = queue_size
+        self.concurrency = concurrency
+        self.busy = dict.fromkeys(self.STAGES, 0.0)
+        self.depths = {name: [] for name in self.QUEUES}
+        self.elapsed = 0.0
+
+    def add_busy(self, stage, seconds):
+        self.busy[stage] += seconds
+
+    def sample(self, name, depth):
+        self.depths[name].append(depth)
+
+    def summary(self):
+        """汇总统计并判断瓶颈
+        Returns:
+            summary: 包含 elapsed、stages（各阶段耗时和利用率）、
+                queues（平均深度、最大深度、满和空的比例）、bottleneck 的字典
+        """
+        stages = {}
+        for stage in self.STAGES:
+            capacity = self.elapsed * self.concurrency[stage]
+            stages[stage] = {
+                "busy": self.busy[stage],
+                "workers": self.concurrency[stage],
+                "utilization": self.busy[stage] / capacity if capacity else 0.0,
+            }
+        queues = {}
+        for name, depths in self.depths.items():
+            count = len(depths) or 1
+            queues[name] = {
+                "average": sum(depths) / count,
+                "max": max(depths, default=0),
+                "full": sum(d >= self.queue_size for d in depths) / count,
+                "empty": sum(d == 0 for d in depths) / count,
+            }
+
+        # 队列经常是满的说明下游处理不过来；否则看哪个阶段最忙
+        busiest = max(self.STAGES, key=lambda stage: stages[stage]["utilization"])
+        if queues["encode"]["full"] > 0.5:
+            bottleneck = "encode"
+        elif queues["write"]["full"] > 0.5:
+            bottleneck = "write"
+        elif stages[busiest]["utilization"] >= 0.5:
+            bottleneck = busiest
+        else:
+            bottleneck = "balanced"
+        return {
+            "elapsed": self.elapsed,
+            "queue_size": self.queue_size,
+            "stages": stages,
+            "queues": queues,
+            "bottleneck": bottleneck,
+        }
+
+
+async def _streaming_pipeline(
+    image_files, settings, on_result, workers, io_workers, queue_size, cache, metrics
+):
+    """读取、编码、写入三个阶段通过有界队列连接，队列满时上游自动等待"""
+    loop = asyncio.get_running_loop()
+    paths = deque(image_files)
+    encode_queue = asyncio.Queue(maxsize=queue_size)
+    write_queue = asyncio.Queue(maxsize=queue_size)
+
+    with ThreadPoolExecutor(max_workers=io_workers) as io_pool, ProcessPoolExecutor(
+        max_workers=workers
+    ) as cpu_pool:
+
+        async def timed(stage, executor, func, *args):
+            start = time.perf_counter()
+            try:
+                return await loop.run_in_executor(executor, func, *args)
+            finally:
+                metrics.add_busy(stage, time.perf_counter() - start)
+
+        async def reader():
+            while paths:
+                image_path = paths.popleft()
+                result = new_convert_result(image_path)
+                try:
+                    data = await timed("read", io_pool, read_source, image_path)
+                    result["hash"] = hashlib.sha256(data).hexdigest()
+                    cache_key = None
+                    if cache:
+                        cache_key = cache.key(result["hash"], settings)
+                        info = await timed(
+                            "read",
+                            io_pool,
+                            cache.fetch,
+                            cache_key,
+                            webp_output_path(image_path),
+                        )
+                        if info is not None:
+                            result.update(info, success=True, cached=True)
+                            await write_queue.put((result, None, None, None))
+                            continue
+                    await encode_queue.put((result, data, cache_key))
+                except Exception as e:
+                    result["error"] = str(e)
+                    await write_queue.put((result, None, None, None))
+
+        async def encoder():
+            while (item := await encode_queue.get()) is not None:
+                result, data, cache_key = item
+                try:
+                    info, payloads = await timed(
+                        "encode",
+                        cpu_pool,
+                        _encode_stage,
+                        (data, result["path"], settings),
+                    )
+                    await write_queue.put((result, info, payloads, cache_key))
+                except Exception as e:
+                    result["error"] = str(e)
+                    await write_queue.put((result, None, None, None))
+
+        async def writer():
+            while (item := await write_queue.get()) is not None:
+                result, info, payloads, cache_key = item
+                if info is not None:
+                    try:
+                        start = time.perf_counter()
+                        await timed("write", io_pool, write_outputs, payloads)
+                        info["timings"]["write_ms"] = (
+                            time.perf_counter() - start
+                        ) * 1000
+                        if cache_key:
+                            await timed(
+                                "write",
+                                io_pool,
+                                cache.store,
+                                cache_key,
+                                webp_output_path(result["path"]),
+                                info,
+                            )
+                        result.update(info, success=True)
+                    except Exception as e:
+                        result["error"] = str(e)
+                on_result(result)
+
+        async def sampler():
+            while True:
+                metrics.sample("encode", encode_queue.qsize())
+                metrics.sample("write", write_queue.qsize())
+                await asyncio.sleep(0.05)
+
+        start = time.perf_counter()
+        sampling = asyncio.create_task(sampler())
+        writers = [asyncio.create_task(writer()) for _ in range(io_workers)]
+        encoders = [asyncio.create_task(encoder()) for _ in range(workers)]
+        await asyncio.gather(*(reader() for _ in range(io_workers)))
+        for _ in encoders:
+            await encode_queue.put(None)
+        await asyncio.gather(*encoders)
+        for _ in writers:
+            await write_queue.put(None)
+        await asyncio.gather(*writers)
+        sampling.cancel()
+        metrics.elapsed = time.perf_counter() - start
+
+
+def convert_streaming(
+    image_files,
+    settings,
+    on_result,
+    workers=None,
+    io_workers=None,
+    queue_size=DEFAULT_QUEUE_SIZE,
+    cache_dir=None,
+):
+    """以流水线方式转换图片：线程池读取、进程池编码、线程池原子写入，三者重叠进行
+    Args:
+        image_files: 要转换的图片路径列表（覆盖与否应在调用前确定）
+        settings: encoder_settings 生成的编码参数
+        on_result: 每个文件处理完后调用，参数见 _convert_worker 的返回值
+        workers: 编码进程数，默认为CPU核心数
+        io_workers: 读写线程数，默认为编码进程数的两倍
+        queue_size: 阶段之间的队列长度，同时驻留内存的源文件和编码结果不超过它的两倍
+        cache_dir: 编码缓存目录，默认不使用缓存
+    Returns:
+        summary: 见 PipelineMetrics.summary
+    """
+    workers = workers or os.cpu_count() or 1
+    io_workers = io_workers or workers * 2
+    metrics = PipelineMetrics(
+        queue_size, {"read": io_workers, "encode": workers, "write": io_workers}
+    )
+    cache = EncodeCache(cache_dir) if cache_dir else None
+    asyncio.run(
+        _streaming_pipeline(
+            image_files,
+            settings,
+            on_result,
+            workers,
+            io_workers,
+            queue_size,
+            cache,
+            metrics,
+        )
+    )
+    return metrics.summary()
+
+
+def print_pipeline_metrics(summary):
+    """显示流水线各阶段的耗时、队列深度和瓶颈判断"""
+    stage_names = {"read": "读取", "encode": "编码", "write": "写入"}
+    print(
+        f"\n{Fore.CYAN}流水线统计（用时 {summary['elapsed']:.2f} 秒）{Style.RESET_ALL}"
+    )
+    for stage, stats in summary["stages"].items():
+        print(
+            f"  {stage_names[stage]}: 累计 {stats['busy']:.2f} 秒，"
+            f"{stats['workers']} 个并发，利用率 {stats['utilization']:.0%}"
+        )
+    for name, stats in summary["queues"].items():
+        print(
+            f"  待{stage_names[name]}队列: 平均 {stats['average']:.1f}，"
+            f"最大 {stats['max']}/{summary['queue_size']}，"
+            f"满 {stats['full']:.0%}，空 {stats['empty']:.0%}"
+        )
+    verdicts = {
+        "encode": "编码跟不上读取，CPU 是瓶颈，可以增加进程数",
+        "write": "写入跟不上编码，磁盘是瓶颈",
+        "read": "读取供不上编码，磁盘是瓶颈，可以增加读写线程数",
+        "balanced": "各阶段基本均衡",
+    }
+    print(f"  判断: {verdicts[summary['bottleneck']]}")
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    if hours:
+        return f"{hours}:{minutes:02d}:{seconds:02d}"
+    return f"{minutes:02d}:{seconds:02d}"
+
+
+def preview_files(files, limit=10):
+    """只列出前几个文件，文件很多时避免刷屏"""
+    for file in files[:limit]:
+        print(file)
+    if len(files) > limit:
+        print(f"……以及其他 {len(files) - limit} 个文件")
+
+
+class ProgressReporter:
+    """在同一行刷新完成数、速度和剩余时间，逐个文件的信息只在 verbose 时输出
+
+    终端中每 0.1 秒刷新一次；输出被重定向时每 5 秒打印一行。
+    指定 log_path 时逐个文件的信息同时写入该日志文件。
+    """
+
+    def __init__(self, total, label="处理", verbose=False, log_path=None, stream=None):
+        self.stream = stream or sys.stdout
+        self.interactive = self.stream.isatty()
+        self.total = total
+        self.label = label
+        self.verbose = verbose
+        self.log_path = log_path
+        self.log_file = open(log_path, "a", encoding="utf-8") if log_path else None
+        self.done = 0
+        self.done_bytes = 0
+        self.start = time.perf_counter()
+        self.last_draw = self.start
+
+    def status(self):
+        elapsed = max(time.perf_counter() - self.start, 1e-9)
+        rate = self.done / elapsed
+        parts = [f"{self.label} {self.done}/{self.total}"]
+        if self.total:
+            parts.append(f"{self.done / self.total:.0%}")
+        parts.append(f"{rate:.1f} 个/秒")
+        if self.done_bytes:
+            parts.append(f"{self.done_bytes / 1024 / 1024 / elapsed:.1f} MB/秒")
+        if rate and self.done < self.total:
+            parts.append(f"剩余 {format_duration((self.total - self.done) / rate)}")
+        else:
+            parts.append(f"用时 {format_duration(elapsed)}")
+        return "  ".join(parts)
+
+    def draw(self, force=False):
+        now = time.perf_counter()
+        if not force and now - self.last_draw < (0.1 if self.interactive else 5.0):
+            return
+        self.last_draw = now
+        if self.interactive:
+            self.stream.write(f"\r{self.status()}\033[K")
+        else:
+            self.stream.write(self.status() + "\n")
+        self.stream.flush()
+
+    def advance(self, count=1, nbytes=0):
+        self.done += count
+        self.done_bytes += nbytes
+        self.draw()
+
+    def echo(self, message):
+        """在进度行上方输出一行"""
+        if self.interactive:
+            # 进度行被覆盖，下次立即重画
+            self.stream.write("\r\033[K")
+            self.last_draw = 0.0
+        print(message, file=self.stream)
+
+    def detail(self, message):
+        """逐个文件的信息，verbose 时输出，有日志文件时写入日志"""
+        if self.log_file:
+            self.log_file.write(message + "\n")
+        if self.verbose:
+            self.echo(message)
+
+    def warn(self, message):
+        """错误等必须看到的信息，始终输出"""
+        if self.log_file:
+            self.log_file.write(message + "\n")
+        self.echo(f"{Fore.RED}{message}{Style.RESET_ALL}")
+
+    def close(self):
+        self.draw(force=True)
+        if self.interactive:
+            self.stream.write("\n")
+        if self.log_file:
+            self.log_file.close()
+            print(f"逐个文件的详细信息已写入 {self.log_path}")
+
+
+class RunReport:
+    """一次运行的结构化报告：各阶段耗时和每个文件的指标
+
+    discovery、backup、convert 等阶段记录的是实际经过的时间；
+    decode、encode、write 是所有文件的耗时之和，并行时会超过实际时间。
+    """
+
+    FILE_FIELDS = (
+        "path",
+        "status",
+        "input_bytes",
+        "output_bytes",
+        "ratio",
+        "decode_ms",
+        "encode_ms",
+        "write_ms",
+        "total_ms",
+        "quality",
+        "content_class",
+        "format",
+        "metadata_stripped_bytes",
+    )
+
+    def __init__(self, command=None):
+        self.command = command
+        self.created = datetime.now()
+        self.stages = {}
+        self.files = []
+
+    def add_stage(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    @contextmanager
+    def stage(self, name):
+        """记录 with 块内经过的时间"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_stage(name, time.perf_counter() - start)
+
+    def add_file(self, result, input_bytes):
+        """记录一个文件的转换结果，见 _convert_worker 的返回值"""
+        output_bytes = 0
+        for output_path in result["outputs"]:
+            try:
+                output_bytes += os.path.getsize(output_path)
+            except OSError:
+                pass
+        if not result["success"]:
+            status = "error"
+        elif result.get("duplicate_of"):
+            status = "duplicate"
+        elif result["cached"]:
+            status = "cached"
+        elif not result["outputs"]:
+            status = "kept"
+        else:
+            status = "converted"
+
+        # 复用的结果带着原图的耗时，不重复计入
+        timings = {} if status == "duplicate" else result.get("timings") or {}
+        for stage in ("decode", "encode", "write"):
+            if f"{stage}_ms" in timings:
+                self.add_stage(stage, timings[f"{stage}_ms"] / 1000)
+        self.files.append(
+            {
+                "path": result["path"],
+                "status": status,
+                "input_bytes": input_bytes,
+                "output_bytes": output_bytes,
+                "ratio": output_bytes / input_bytes if input_bytes else None,
+                "decode_ms": timings.get("decode_ms"),
+                "encode_ms": timings.get("encode_ms"),
+                "write_ms": timings.get("write_ms"),
+                "total_ms": sum(timings.values()) if timings else None,
+                "quality": result["quality"],
+                "content_class": result["content_class"],
+                "format": result.get("format"),
+                "metadata_stripped_bytes": result.get("metadata_stripped", 0),
+            }
+        )
+
+    def slowest(self, count=10):
+        timed = [record for record in self.files if record["total_ms"] is not None]
+        return sorted(timed, key=lambda record: record["total_ms"], reverse=True)[
+            :count
+        ]
+
+    def to_dict(self, slowest=10):
+        converted = [record for record in self.files if record["output_bytes"]]
+        input_bytes = sum(record["input_bytes"] for record in converted)
+        output_bytes = sum(record["output_bytes"] for record in converted)
+        statuses = {}
+        for record in self.files:
+            statuses[record["status"]] = statuses.get(record["status"], 0) + 1
+        return {
+            "command": self.command,
+            "created": self.created.isoformat(timespec="seconds"),
+            "stages": self.stages,
+            "totals": {
+                "files": len(self.files),
+                "statuses": statuses,
+                "input_bytes": input_bytes,
+                "output_bytes": output_bytes,
+                "ratio": output_bytes / input_bytes if input_bytes else None,
+                "metadata_stripped_bytes": sum(
+                    record["metadata_stripped_bytes"] for record in self.files
+                ),
+            },
+            "slowest": self.slowest(slowest),
+            "files": self.files,
+        }
+
+    def save(self, path, slowest=10):
+        """按扩展名保存为 JSON 或 CSV；CSV 每行一个文件，阶段耗时只在 JSON 中"""
+        if path.lower().endswith(".csv"):
+            with open(path, "w", encoding="utf-8", newline="") as f:
+                writer = csv.DictWriter(f, fieldnames=self.FILE_FIELDS)
+                writer.writeheader()
+                writer.writerows(self.files)
+        else:
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(self.to_dict(slowest), f, ensure_ascii=False, indent=2)
+
+    def print_summary(self, slowest=10):
+        stage_names = {
+            "discovery": "扫描",
+            "backup": "备份",
+            "convert": "转换",
+            "decode": "解码（累计）",
+            "encode": "编码（累计）",
+            "write": "写入（累计）",
+            "markdown_scan": "分析Markdown",
+            "rewrite": "更新引用",
+            "delete": "删除原图",
+        }
+        print(f"\n{Fore.CYAN}各阶段耗时{Style.RESET_ALL}")
+        for name, seconds in self.stages.items():
+            print(f"  {stage_names.get(name, name)}: {seconds:.2f} 秒")
+        records = self.slowest(slowest)
+        if records:
+            print(f"\n{Fore.CYAN}最慢的 {len(records)} 个文件{Style.RESET_ALL}")
+            for record in records:
+                ratio = f"{record['ratio']:.0%}" if record["ratio"] is not None else "-"
+                print(
+                    f"  {record['total_ms']:8.0f} ms  "
+                    f"{record['input_bytes'] / 1024:8.0f} KB -> {ratio:>4}  "
+                    f"{record['path']}"
+                )
+
+
+def process_images(folder_path, webp_index=None, scan=None, journal=None):
     """处理图片转换"""
-    image_files = find_image_files(folder_path)
+    if scan is None:
+        scan = SiteScan(folder_path)
+    image_files = scan.images
     if not image_files:
         print(f"{Fore.YELLOW}未找到任何图片文件！{Style.RESET_ALL}")
         return False
 
     print(f"\n找到 {len(image_files)} 个图片文件。")
     print("\n文件列表:")
-    for file in image_files:
-        print(file)
+    preview_files(image_files)
 
     response = input("\n是否将这些图片转换为webp格式？(y/n): ").strip().lower()
     if response != "y":
         print("操作已取消。")
         return False
 
-    lossless_response = input("\n是否使用无损压缩？(y/n): ").strip().lower()
+    lossless_response = (
+        input("\n是否使用无损压缩？(y/n，输入 a 按图片内容自动判断): ").strip().lower()
+    )
     use_lossless = lossless_response == "y"
+    auto_classify = lossless_response == "a"
+    if auto_classify and np is None:
+        print(f"{Fore.YELLOW}自动判断需要安装 numpy，将使用有损压缩{Style.RESET_ALL}")
+        auto_classify = False
 
     quality = 80  # 默认质量
+    if auto_classify:
+        print("\n将按图片内容自动选择：少色图无损、截图近无损、照片有损")
+        print("请为照片类图片设置压缩质量")
     if not use_lossless:
-        print("\n将使用有损压缩模式")
+        if not auto_classify:
+            print("\n将使用有损压缩模式")
         quality_input = input(
             f"请输入压缩质量(1-100，默认{quality}，直接回车使用默认值): "
         ).strip()
@@ -665,58 +3512,381 @@ def process_images(folder_path):
     else:
         print("\n将使用无损压缩模式（文件体积较大但质量无损）")
 
-    # 保险
-    need_confirm = (
+    # 保险
+    need_confirm = (
+        input(
+            f"\n{Fore.YELLOW}是否需要逐个确认覆盖已存在的文件？(y/n): {Style.RESET_ALL}"
+        )
+        .strip()
+        .lower()
+        == "y"
+    )
+    if not need_confirm:
+        print("\n将自动覆盖所有已存在的文件")
+    else:
+        print("\n处理过程中可以输入 'gg' 来切换到自动覆盖模式")
+
+    workers = os.cpu_count() or 1
+    workers_input = input(
+        f"\n请输入并行转换的进程数(默认{workers}，直接回车使用默认值): "
+    ).strip()
+    if workers_input:
+        try:
+            workers = max(1, int(workers_input))
+        except ValueError:
+            print(
+                f"{Fore.YELLOW}输入的进程数无效，将使用默认值 {workers}{Style.RESET_ALL}"
+            )
+
+    streaming = (
         input(
-            f"\n{Fore.YELLOW}是否需要逐个确认覆盖已存在的文件？(y/n): {Style.RESET_ALL}"
+            "\n是否使用流式流水线（读取、编码、写入重叠进行，结束后显示各阶段统计）？(y/n，默认n): "
         )
         .strip()
         .lower()
         == "y"
     )
-    if not need_confirm:
-        print("\n将自动覆盖所有已存在的文件")
-    else:
-        print("\n处理过程中可以输入 'gg' 来切换到自动覆盖模式")
+
+    manifest = ConversionManifest(folder_path)
+    incremental = bool(manifest.entries) and (
+        input("\n是否跳过上次转换后未变化的图片（增量转换）？(y/n，默认y): ")
+        .strip()
+        .lower()
+        != "n"
+    )
+
+    convert_images(
+        folder_path,
+        lossless=use_lossless,
+        quality=quality,
+        overwrite="ask" if need_confirm else "always",
+        workers=workers,
+        incremental=incremental,
+        image_files=image_files,
+        webp_index=webp_index,
+        scan=scan,
+        auto_classify=auto_classify,
+        cache=EncodeCache(),
+        streaming=streaming,
+        journal=journal,
+    )
+    return True
+
+
+def convert_images(
+    folder_path,
+    lossless=False,
+    quality=80,
+    overwrite="always",
+    workers=None,
+    incremental=True,
+    image_files=None,
+    webp_index=None,
+    scan=None,
+    max_dimension=None,
+    memory_budget=None,
+    widths=None,
+    target=None,
+    auto_classify=False,
+    metadata="strip",
+    formats=None,
+    keep="smallest",
+    avif_quality=None,
+    deduplicate=True,
+    cache=None,
+    cache_size=DEFAULT_CACHE_SIZE_MB * 1024 * 1024,
+    streaming=False,
+    queue_size=DEFAULT_QUEUE_SIZE,
+    report=None,
+    verbose=False,
+    log_path=None,
+    journal=None,
+):
+    """批量转换图片，不做任何交互（overwrite="ask" 时除外），供命令行和其他脚本调用
+    Args:
+        folder_path: 文件夹路径
+        lossless: 是否使用无损压缩
+        quality: 压缩质量(1-100)
+        overwrite: 已存在的webp如何处理，"always" 覆盖、"never" 跳过、"ask" 逐个询问
+        workers: 并行进程数，默认为CPU核心数
+        incremental: 是否跳过上次转换后未变化的图片
+        image_files: 要转换的图片列表，默认扫描整个文件夹
+        webp_index: 已建立的 WebpIndex，新生成的webp会同步加入索引
+        scan: 已完成的 SiteScan，默认重新扫描
+        max_dimension: 输出的最长边，超过时等比缩小
+        memory_budget: 同时解码的图片估算内存上限（字节），默认不限制
+        widths: 额外生成的响应式宽度列表，如 [480, 960, 1600]
+        target: 自适应质量的目标，见 encoder_settings，启用后 quality 不再使用
+        auto_classify: 是否按图片内容自动选择无损、近无损或有损
+        metadata: 元数据策略，"strip" 全部去除、"icc" 保留色彩配置、"all" 全部保留
+        formats: 多格式转换的候选格式，见 OUTPUT_FORMATS，默认只生成webp
+        keep: 多格式转换时 "smallest" 只保留最小的结果，"all" 全部保留供 <picture> 使用；
+            两种情况下Markdown中的引用都指向最小的结果，选择记录在转换记录中
+        avif_quality: avif 的压缩质量，默认由 quality 推算
+        deduplicate: 内容相同的图片是否只编码一次，其余直接链接或复制结果
+        cache: EncodeCache，提供时优先从缓存中取编码结果
+        cache_size: 缓存容量上限（字节），运行结束后淘汰最久未使用的条目
+        streaming: 是否使用流式流水线（读取、编码、写入重叠进行），见 convert_streaming；
+            此时 memory_budget 不再使用，内存由队列长度限制
+        queue_size: 流式流水线中阶段之间的队列长度
+        report: RunReport，提供时记录转换耗时和每个文件的指标
+        verbose: 是否逐个输出转换的文件，默认只显示进度
+        log_path: 逐个文件信息的日志路径，见 ProgressReporter
+        journal: RunJournal，提供时逐个记录完成的文件，继续中断的运行时跳过它们
+    Returns:
+        stats: 包含 converted、skipped、unchanged、kept、deduplicated、resumed、errors 等的字典，
+            流式流水线还包含 pipeline 统计
+    """
+    if scan is None:
+        scan = SiteScan(folder_path)
+    if image_files is None:
+        image_files = scan.images
+    if webp_index is None:
+        webp_index = WebpIndex(folder_path, scan=scan)
+    workers = workers or os.cpu_count() or 1
+    need_confirm = overwrite == "ask"
 
     converted_count = 0
     existing_count = 0
+    unchanged_count = 0
+    kept_count = 0
+    class_counts = {}
+    format_counts = {}
+
+    manifest = ConversionManifest(folder_path)
+    settings = encoder_settings(
+        lossless,
+        quality,
+        max_dimension,
+        widths,
+        target,
+        auto_classify,
+        metadata,
+        formats,
+        keep,
+        avif_quality,
+    )
+    resumed_count = journal.begin_phase("convert", settings) if journal else 0
 
-    print("\n开始转换...")
+    # 子进程无法交互，先在主进程中确认好要覆盖的文件
+    files_to_convert = []
     for image_path in image_files:
-        result = convert_to_webp(
-            image_path,
-            lossless=use_lossless,
-            need_confirm=need_confirm,
-            quality=quality,
-        )
-        if result == "gg":
-            print(f"\n{Fore.YELLOW}切换到自动覆盖模式{Style.RESET_ALL}")
-            need_confirm = False
-            # 使用自动模式
-            if convert_to_webp(
-                image_path, lossless=use_lossless, need_confirm=False, quality=quality
-            ):
-                converted_count += 1
-                print(f"已转换: {image_path}")
-            else:
+        if resumed_count and journal.is_done("convert", image_path):
+            continue
+        if incremental and manifest.is_up_to_date(
+            image_path, settings, webp_index.exists, scan.stat
+        ):
+            unchanged_count += 1
+            continue
+        output_path = webp_output_path(image_path)
+        # 由本工具生成过的webp在源文件或参数变化后直接重新生成；
+        # 中断前已开始处理的图片可能已经写出了webp，还没有记入转换记录，同样重新生成
+        if (
+            webp_index.exists(output_path)
+            and not manifest.is_tracked(image_path)
+            and not (journal and journal.was_queued("convert", image_path))
+        ):
+            if overwrite == "never":
                 existing_count += 1
-        elif result:
+                continue
+            if need_confirm:
+                response = (
+                    input(f"\n文件 {output_path} 已存在，是否覆盖？(y/n/gg，默认n): ")
+                    .strip()
+                    .lower()
+                )
+                if response == "gg":
+                    print(f"\n{Fore.YELLOW}切换到自动覆盖模式{Style.RESET_ALL}")
+                    need_confirm = False
+                elif response != "y":
+                    print("跳过该文件")
+                    existing_count += 1
+                    continue
+        files_to_convert.append(image_path)
+    if journal and files_to_convert:
+        journal.queue("convert", files_to_convert)
+
+    # 内容完全相同的图片只编码一次
+    duplicates = {}
+    if deduplicate:
+        duplicates = find_duplicate_images(files_to_convert, scan.stat, workers)
+        duplicate_paths = {path for dups in duplicates.values() for path in dups}
+        files_to_convert = [
+            path for path in files_to_convert if path not in duplicate_paths
+        ]
+    dedup_count = 0
+    dedup_bytes = 0
+    cache_hits = 0
+    stripped_bytes = 0
+
+    errors = []
+
+    def handle_result(result):
+        nonlocal converted_count, kept_count, stripped_bytes
+        image_path = result["path"]
+        details = {"quality": result["quality"]} if "target" in settings else {}
+        label = ""
+        if result["content_class"]:
+            details["content_class"] = result["content_class"]
+            details["features"] = result["features"]
+            class_counts[result["content_class"]] = (
+                class_counts.get(result["content_class"], 0) + 1
+            )
+            label = CONTENT_CLASS_NAMES[result["content_class"]]
+        if result["quality"] and "target" in settings:
+            label = f"{label} 质量 {result['quality']}".strip()
+        if result.get("frames"):
+            label = f"{label} 动图 {result['frames']} 帧".strip()
+        if result.get("format") and result["outputs"]:
+            details["format"] = result["format"]
+            details["output"] = manifest._key(result["outputs"][0])
+            label = f"{label} {FORMAT_NAMES[result['format']]}".strip()
+        if result["cached"]:
+            label = f"{label} 来自缓存".strip()
+        if result.get("duplicate_of"):
+            details["duplicate_of"] = manifest._key(result["duplicate_of"])
+            label = f"{label} 复用相同图片的结果".strip()
+        input_bytes = scan.stat(image_path).st_size
+        if report:
+            report.add_file(result, input_bytes)
+        if result["success"] and not result["outputs"]:
+            # 自适应模式或动图的webp没有更小，保留原图
+            kept_count += 1
+            details["kept_original"] = True
+            manifest.record(image_path, settings, result["hash"], details)
+            if journal:
+                journal.done("convert", image_path)
+            progress.detail(f"保留原图: {image_path}")
+        elif result["success"]:
             converted_count += 1
-            print(f"已转换: {image_path}")
+            stripped_bytes += result.get("metadata_stripped", 0)
+            manifest.record(image_path, settings, result["hash"], details)
+            for output_path in result["outputs"]:
+                webp_index.add(output_path)
+            if result.get("format"):
+                webp_index.choose(result["outputs"][0])
+                format_counts[result["format"]] = (
+                    format_counts.get(result["format"], 0) + 1
+                )
+            if journal:
+                journal.done("convert", image_path)
+            progress.detail(f"已转换: {image_path}" + (f"（{label}）" if label else ""))
         else:
-            existing_count += 1
+            errors.append((image_path, result["error"]))
+            progress.warn(f"转换 {image_path} 时出错: {result['error']}")
+        progress.advance(nbytes=input_bytes)
+
+    def collect(result):
+        nonlocal cache_hits, dedup_count, dedup_bytes
+        cache_hits += result["cached"]
+        handle_result(result)
+        for duplicate_path in duplicates.get(result["path"], ()):
+            handle_result(replicate_result(result, duplicate_path))
+            if result["success"]:
+                dedup_count += 1
+                dedup_bytes += scan.stat(duplicate_path).st_size
+
+    cache_dir = cache.cache_dir if cache else None
+    pipeline_summary = None
+    progress = ProgressReporter(
+        len(files_to_convert) + sum(len(dups) for dups in duplicates.values()),
+        "转换",
+        verbose,
+        log_path,
+    )
+    start = time.perf_counter()
+    if streaming:
+        print(f"\n开始转换...（流式流水线，{workers} 个编码进程）")
+        pipeline_summary = convert_streaming(
+            files_to_convert,
+            settings,
+            collect,
+            workers=workers,
+            queue_size=queue_size,
+            cache_dir=cache_dir,
+        )
+    else:
+        print(f"\n开始转换...（{workers} 个进程）")
+        for result in iter_convert_parallel(
+            files_to_convert,
+            settings,
+            workers=workers,
+            memory_budget=memory_budget,
+            cache_dir=cache_dir,
+        ):
+            collect(result)
+    progress.close()
+    manifest.save()
+    if report:
+        report.add_stage("convert", time.perf_counter() - start)
 
     print(f"\n{Fore.GREEN}转换完成！{Style.RESET_ALL}")
     print(f"成功转换: {converted_count} 个文件")
+    if resumed_count > 0:
+        print(f"中断前已完成: {resumed_count} 个文件")
+    if unchanged_count > 0:
+        print(f"未变化: {unchanged_count} 个文件")
+    if kept_count > 0:
+        print(f"webp 没有更小而保留原图: {kept_count} 个文件")
+    if stripped_bytes > 0:
+        print(f"去除元数据节省: {stripped_bytes / 1024:.1f} KB")
+    if cache:
+        removed_count, freed_bytes = cache.evict(cache_size)
+        print(f"编码缓存命中: {cache_hits} 个文件")
+        if removed_count:
+            print(
+                f"缓存超过上限，已淘汰 {removed_count} 个条目"
+                f"（{freed_bytes / 1024 / 1024:.1f} MB）"
+            )
+    if dedup_count > 0:
+        print(
+            f"重复图片: {dedup_count} 个直接复用了相同图片的结果，"
+            f"省去 {dedup_count} 次编码（{dedup_bytes / 1024 / 1024:.1f} MB）"
+        )
+    if format_counts:
+        print(
+            "多格式选择："
+            + "，".join(
+                f"{FORMAT_NAMES[name]} {count} 个"
+                for name, count in format_counts.items()
+            )
+        )
+    if class_counts:
+        print(
+            "自动判断："
+            + "，".join(
+                f"{CONTENT_CLASS_NAMES[name]} {count} 个"
+                for name, count in class_counts.items()
+            )
+        )
     if existing_count > 0:
         print(f"跳过 {existing_count} 个文件")
-    return True
+    if pipeline_summary:
+        print_pipeline_metrics(pipeline_summary)
+    if errors:
+        print(f"{Fore.RED}其中 {len(errors)} 个文件转换失败：{Style.RESET_ALL}")
+        for image_path, error in errors:
+            print(f"  {image_path}: {error}")
+    return {
+        "converted": converted_count,
+        "skipped": existing_count,
+        "unchanged": unchanged_count,
+        "kept": kept_count,
+        "resumed": resumed_count,
+        "classes": class_counts,
+        "formats": format_counts,
+        "deduplicated": dedup_count,
+        "deduplicated_bytes": dedup_bytes,
+        "cache_hits": cache_hits,
+        "metadata_stripped_bytes": stripped_bytes,
+        "pipeline": pipeline_summary,
+        "errors": errors,
+    }
 
 
-def process_markdown(folder_path):
+def process_markdown(folder_path, webp_index=None, scan=None, journal=None):
     """处理Markdown文件"""
-    markdown_files = find_markdown_files(folder_path)
+    markdown_files = scan.markdown if scan else find_markdown_files(folder_path)
     if not markdown_files:
         print("未找到任何Markdown文件！")
         return False
@@ -730,20 +3900,1011 @@ def process_markdown(folder_path):
     else:
         print("\n将自动替换所有可替换的图片引用")
 
-    updated_count = 0
+    rewrite_references(
+        folder_path,
+        need_confirm=need_confirm,
+        replace_direct=None,
+        markdown_files=markdown_files,
+        webp_index=webp_index,
+        journal=journal,
+    )
+    return True
+
+
+def rewrite_references(
+    folder_path,
+    need_confirm=False,
+    replace_direct=True,
+    markdown_files=None,
+    webp_index=None,
+    workers=None,
+    scan=None,
+    srcset=False,
+    report=None,
+    verbose=False,
+    log_path=None,
+    reference_index=None,
+    journal=None,
+):
+    """批量更新Markdown中的图片引用，供命令行和其他脚本调用
+
+    先用引用索引找出还有可替换引用的文件，并发分析这些文件得到替换计划，
+    确认完毕后再并发写入。
+    Args:
+        folder_path: 文件夹路径
+        need_confirm: 是否需要逐个确认替换
+        replace_direct: 是否替换直接引用，None 表示展示示例后询问
+        markdown_files: 要处理的Markdown文件列表，默认扫描整个文件夹
+        webp_index: 已建立的 WebpIndex，默认重新扫描
+        workers: 并行数，默认为CPU核心数
+        scan: 已完成的 SiteScan，默认重新扫描
+        srcset: 是否为 <img> 和具名参数的 shortcode 补充响应式图片的 srcset
+        report: RunReport，提供时记录分析和写入的耗时
+        verbose: 是否逐个输出更新的文件
+        log_path: 逐个文件信息的日志路径，见 ProgressReporter
+        reference_index: 已加载的 ReferenceIndex，默认从站点目录加载，结束后保存
+        journal: RunJournal，提供时记录更新完成的文件，继续中断的运行时跳过它们
+    Returns:
+        updated_count: 更新的文件数量
+    """
+    full_scan = markdown_files is None
+    if markdown_files is None or webp_index is None:
+        scan = scan or SiteScan(folder_path)
+    if markdown_files is None:
+        markdown_files = scan.markdown
+    if webp_index is None:
+        webp_index = WebpIndex(folder_path, scan=scan)
+    if reference_index is None:
+        reference_index = ReferenceIndex(folder_path, webp_index.static_roots)
+
+    report = report or RunReport()
+    if journal:
+        resumed_count = journal.begin_phase(
+            "rewrite", {"replace_direct": replace_direct, "srcset": srcset}
+        )
+        if resumed_count:
+            print(f"\n中断前已更新 {resumed_count} 个文件，跳过")
+    print("\n开始分析Markdown文件...")
+    with report.stage("markdown_scan"):
+        reference_index.update(
+            markdown_files, scan.stat if scan else os.stat, prune=full_scan
+        )
+        replaceable = set(reference_index.posts_with_replaceable(webp_index.output_for))
+        candidates = [
+            path
+            for path in markdown_files
+            if os.path.normpath(os.path.abspath(path)) in replaceable
+            and not (journal and journal.is_done("rewrite", path))
+        ]
+        plan = plan_markdown_rewrites(candidates, webp_index, workers, srcset)
+    approved = review_rewrite_plan(plan, need_confirm, replace_direct)
 
     print("\n开始更新Markdown文件...")
-    for md_file in markdown_files:
-        if replace_image_references(md_file, need_confirm):
-            updated_count += 1
-            print(f"已更新: {md_file}")
+    progress = ProgressReporter(len(approved), "更新", verbose, log_path)
+    with report.stage("rewrite"):
+        updated_files = apply_rewrite_plan(approved, workers, journal, progress)
+    progress.close()
+    reference_index.update(updated_files, prune=False)
+    reference_index.save()
 
     print("\nMarkdown处理完成！")
-    print(f"已更新 {updated_count} 个文件中的图片引用")
-    return True
+    print(f"已更新 {len(updated_files)} 个文件中的图片引用")
+    return len(updated_files)
+
+
+class InotifyWatcher:
+    """基于 inotify 的目录监视，通过 ctypes 调用 libc，只支持 Linux"""
+
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_Q_OVERFLOW = 0x00004000
+    IN_ISDIR = 0x40000000
+    WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    EVENT = struct.Struct("iIII")
+
+    def __init__(self, folder_path, exclude=DEFAULT_EXCLUDES):
+        self.folder_path = folder_path
+        self.exclude = tuple(exclude or ())
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 失败")
+        self.watches = {}
+        self.add_tree(folder_path)
+
+    def add_tree(self, root):
+        """监视 root 及其所有子目录
+        Returns:
+            files: 其中已有的文件，目录是新建的时这些文件可能还没有触发过事件
+        """
+        files = []
+        stack = [root]
+        while stack:
+            current_dir = stack.pop()
+            wd = self.libc.inotify_add_watch(
+                self.fd, os.fsencode(current_dir), self.WATCH_MASK
+            )
+            if wd < 0:
+                continue
+            self.watches[wd] = current_dir
+            try:
+                with os.scandir(current_dir) as it:
+                    for entry in it:
+                        rel_path = os.path.relpath(entry.path, self.folder_path)
+                        rel_path = rel_path.replace(os.sep, "/")
+                        if self.exclude and _matches_any(
+                            rel_path, entry.name, self.exclude
+                        ):
+                            continue
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        else:
+                            files.append(entry.path)
+            except OSError:
+                continue
+        return files
+
+    def poll(self, timeout):
+        """等待事件
+        Returns:
+            (changed, overflow): 变化的文件路径集合；事件队列溢出时 overflow 为 True
+        """
+        changed = set()
+        overflow = False
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return changed, overflow
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, name_length = self.EVENT.unpack_from(data, offset)
+                offset += self.EVENT.size
+                name = data[offset : offset + name_length].rstrip(b"\0")
+                offset += name_length
+                if mask & self.IN_Q_OVERFLOW:
+                    overflow = True
+                    continue
+                directory = self.watches.get(wd)
+                if directory is None or not name:
+                    continue
+                path = os.path.join(directory, os.fsdecode(name))
+                if mask & self.IN_ISDIR:
+                    if mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                        changed.update(self.add_tree(path))
+                elif mask & self.IN_CREATE:
+                    # 等写完触发 IN_CLOSE_WRITE 再处理
+                    continue
+                else:
+                    changed.add(path)
+        return changed, overflow
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    """定期对比 stat 快照的目录监视，用于没有 inotify 的系统"""
+
+    def __init__(
+        self, folder_path, include=None, exclude=DEFAULT_EXCLUDES, interval=0.5
+    ):
+        self.folder_path = folder_path
+        self.include = include
+        self.exclude = exclude
+        self.interval = interval
+        self.snapshot = self._snapshot()
+
+    def _snapshot(self):
+        snapshot = {}
+        for scan_entry in scan_tree(self.folder_path, self.include, self.exclude):
+            try:
+                stat = scan_entry.stat()
+            except OSError:
+                continue
+            snapshot[scan_entry.path] = (stat.st_mtime_ns, stat.st_size)
+        return snapshot
+
+    def poll(self, timeout):
+        time.sleep(min(timeout, self.interval))
+        snapshot = self._snapshot()
+        changed = {
+            path
+            for path, signature in snapshot.items()
+            if self.snapshot.get(path) != signature
+        }
+        changed.update(self.snapshot.keys() - snapshot.keys())
+        self.snapshot = snapshot
+        return changed, False
+
+    def close(self):
+        pass
+
+
+def create_watcher(
+    folder_path, include=None, exclude=DEFAULT_EXCLUDES, poll=False, interval=0.5
+):
+    """优先使用 inotify，不可用时退回轮询"""
+    if not poll and sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher(folder_path, exclude)
+        except (OSError, AttributeError, TypeError) as e:
+            print(f"{Fore.YELLOW}无法使用 inotify（{e}），改为轮询{Style.RESET_ALL}")
+    return PollingWatcher(folder_path, include, exclude, interval)
+
+
+def watch_site(
+    folder_path,
+    convert_options,
+    replace_direct=True,
+    srcset=False,
+    include=None,
+    exclude=DEFAULT_EXCLUDES,
+    webp_index=None,
+    scan=None,
+    debounce=0.2,
+    poll=False,
+    interval=0.5,
+    verbose=False,
+    log_path=None,
+):
+    """持续监视站点目录，只转换新增或修改的图片，只更新提到它们的Markdown
+    Args:
+        folder_path: 文件夹路径
+        convert_options: 传给 convert_images 的其他参数，如 lossless、quality
+        replace_direct: 是否替换直接引用
+        srcset: 是否补充 srcset
+        include, exclude: 见 scan_tree
+        webp_index, scan: 已建立的索引和扫描结果，默认重新扫描
+        debounce: 最后一个事件之后等待的秒数，期间的变化合并为一批处理
+        poll: 强制使用轮询
+        interval: 轮询间隔（秒）
+        verbose, log_path: 见 ProgressReporter
+    """
+    if scan is None:
+        scan = SiteScan(folder_path, include, exclude)
+    if webp_index is None:
+        webp_index = WebpIndex(folder_path, scan=scan)
+    reference_index = ReferenceIndex(folder_path, webp_index.static_roots)
+    reference_index.update(scan.markdown, scan.stat)
+    reference_index.save()
+    watcher = create_watcher(folder_path, include, exclude, poll, interval)
+    # 自己写入的文件也会触发事件，按绝对路径记下写入后的状态以便忽略
+    own_writes = {}
+
+    def wanted(path):
+        kind = classify_file(os.path.basename(path))
+        if kind not in ("image", "markdown"):
+            return None
+        rel_path = os.path.relpath(path, folder_path).replace(os.sep, "/")
+        name = os.path.basename(path)
+        if exclude and _matches_any(rel_path, name, exclude):
+            return None
+        if include and not _matches_any(rel_path, name, include):
+            return None
+        return kind
+
+    def signature(path):
+        stat = os.stat(path)
+        return stat.st_mtime_ns, stat.st_size
+
+    def process_batch(paths):
+        images = []
+        markdown = set()
+        for path in sorted(paths):
+            kind = wanted(path)
+            if kind is None:
+                continue
+            try:
+                if own_writes.get(os.path.abspath(path)) == signature(path):
+                    continue
+            except FileNotFoundError:
+                if kind == "markdown":
+                    reference_index.update([path], prune=False)
+                scan.refresh([path])
+                continue
+            if kind == "image":
+                images.append(path)
+            else:
+                # posts_referencing 返回绝对路径，统一后同一文件不会处理两次
+                markdown.add(os.path.abspath(path))
+        if not images and not markdown:
+            return
+
+        print(
+            f"\n{Fore.CYAN}[{datetime.now():%H:%M:%S}] 检测到变化：{len(images)} 张图片，{len(markdown)} 个Markdown文件{Style.RESET_ALL}"
+        )
+        scan.refresh(images + list(markdown))
+        reference_index.update(markdown, prune=False)
+        if images:
+            convert_images(
+                folder_path,
+                image_files=images,
+                webp_index=webp_index,
+                scan=scan,
+                incremental=True,
+                verbose=verbose,
+                log_path=log_path,
+                **convert_options,
+            )
+            markdown |= reference_index.posts_referencing(images)
+        if markdown:
+            rewrite_references(
+                folder_path,
+                need_confirm=False,
+                replace_direct=replace_direct,
+                markdown_files=sorted(markdown),
+                webp_index=webp_index,
+                workers=1,
+                srcset=srcset,
+                verbose=verbose,
+                log_path=log_path,
+                reference_index=reference_index,
+            )
+            for md_path in markdown:
+                try:
+                    own_writes[os.path.abspath(md_path)] = signature(md_path)
+                except OSError:
+                    pass
+        reference_index.save()
+
+    kind_name = "inotify" if isinstance(watcher, InotifyWatcher) else "轮询"
+    print(f"\n正在监视 {folder_path}（{kind_name}），按 Ctrl+C 退出")
+    pending = set()
+    last_event = 0.0
+    try:
+        while True:
+            changed, overflow = watcher.poll(debounce if pending else 1.0)
+            if overflow:
+                # 事件丢失，退回到对所有图片做一次增量转换
+                print(f"{Fore.YELLOW}事件过多，重新检查所有文件{Style.RESET_ALL}")
+                scan = SiteScan(folder_path, include, exclude)
+                reference_index.update(scan.markdown, scan.stat)
+                changed = set(scan.images) | set(scan.markdown)
+            if changed:
+                pending |= changed
+                last_event = time.monotonic()
+            elif pending and time.monotonic() - last_event >= debounce:
+                batch, pending = pending, set()
+                process_batch(batch)
+    except KeyboardInterrupt:
+        print("\n已停止监视")
+    finally:
+        watcher.close()
+
+
+def parse_widths(value):
+    """解析命令行中逗号分隔的宽度列表"""
+    try:
+        widths = [int(part) for part in value.split(",") if part.strip()]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"无效的宽度列表: {value}")
+    if not widths or any(width <= 0 for width in widths):
+        raise argparse.ArgumentTypeError(f"无效的宽度列表: {value}")
+    return widths
+
+
+def parse_formats(value):
+    """解析命令行中逗号分隔的格式列表"""
+    formats = [part.strip().lower() for part in value.split(",") if part.strip()]
+    if not formats or any(name not in OUTPUT_FORMATS for name in formats):
+        raise argparse.ArgumentTypeError(
+            f"无效的格式列表: {value}（可选 {', '.join(OUTPUT_FORMATS)}）"
+        )
+    return formats
+
+
+def show_cache_stats(cache, cache_size=None):
+    """显示编码缓存统计
+    Args:
+        cache: EncodeCache
+        cache_size: 提供时先按该容量上限（MB）淘汰
+    """
+    if cache_size is not None:
+        removed_count, freed_bytes = cache.evict(cache_size * 1024 * 1024)
+        print(f"已淘汰 {removed_count} 个条目（{freed_bytes / 1024 / 1024:.1f} MB）")
+    stats = cache.stats()
+
+    def format_time(timestamp):
+        if timestamp is None:
+            return "-"
+        return datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S")
+
+    print(f"\n{Fore.CYAN}编码缓存：{stats['path']}{Style.RESET_ALL}")
+    print(f"编码器：{EncodeCache.encoder_version()}")
+    print(f"条目数：{stats['entries']}")
+    print(f"占用空间：{stats['bytes'] / 1024 / 1024:.1f} MB")
+    print(f"最早使用：{format_time(stats['oldest'])}")
+    print(f"最近使用：{format_time(stats['newest'])}")
+
+
+def show_orphans(orphans, stat=os.stat):
+    """显示没有被引用的文件和总大小"""
+    if not orphans:
+        print(f"\n{Fore.GREEN}所有图片都有Markdown引用{Style.RESET_ALL}")
+        return
+    total_bytes = 0
+    print(f"\n{Fore.CYAN}没有被任何Markdown引用的文件：{Style.RESET_ALL}")
+    for path in orphans:
+        size = stat(path).st_size
+        total_bytes += size
+        print(f"{size / 1024:8.0f} KB  {path}")
+    print(
+        f"\n共 {len(orphans)} 个文件，{total_bytes / 1024 / 1024:.1f} MB"
+        "（模板、配置文件和 CSS 中的引用不在统计范围内）"
+    )
+
+
+def convert_options_from_args(args):
+    """把命令行的转换选项整理为 convert_images 的参数"""
+    return {
+        "lossless": args.lossless,
+        "quality": args.quality,
+        "overwrite": args.overwrite,
+        "workers": args.workers,
+        "max_dimension": args.max_dimension,
+        "memory_budget": (
+            args.memory_budget * 1024 * 1024 if args.memory_budget else None
+        ),
+        "widths": args.widths,
+        "target": target_from_args(args),
+        "auto_classify": args.auto_classify,
+        "metadata": args.metadata,
+        "formats": args.formats,
+        "keep": args.keep,
+        "avif_quality": args.avif_quality,
+        "deduplicate": args.deduplicate,
+        "cache": EncodeCache(args.cache_dir) if args.use_cache else None,
+        "cache_size": args.cache_size * 1024 * 1024,
+        "streaming": args.streaming,
+        "queue_size": args.queue_size,
+    }
+
+
+def target_from_args(args):
+    """根据命令行参数生成自适应质量的目标"""
+    if getattr(args, "target_size", None):
+        return {"type": "bytes", "value": args.target_size * 1024}
+    if getattr(args, "target_ratio", None):
+        return {"type": "ratio", "value": args.target_ratio}
+    if getattr(args, "target_similarity", None):
+        return {"type": "similarity", "value": args.target_similarity}
+    return None
+
+
+def build_parser():
+    """构建命令行参数解析器"""
+    parser = argparse.ArgumentParser(
+        prog="main.py",
+        description=f"Blog-Webp-Assistant v{VERSION}，不带参数运行时进入交互菜单",
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    def add_common(sub):
+        sub.add_argument("folder", help="要处理的文件夹路径")
+        sub.add_argument(
+            "--no-backup",
+            dest="backup",
+            action="store_false",
+            help="处理前不创建备份",
+        )
+        sub.add_argument(
+            "-j",
+            "--workers",
+            type=int,
+            default=None,
+            help="并行处理的进程数（默认CPU核心数）",
+        )
+        sub.add_argument(
+            "--include",
+            action="append",
+            default=None,
+            metavar="GLOB",
+            help="只处理匹配的文件（相对路径或文件名），可重复指定",
+        )
+        sub.add_argument(
+            "--exclude",
+            action="append",
+            default=[],
+            metavar="GLOB",
+            help=f"额外跳过匹配的目录或文件，以 / 开头时只匹配站点根目录下的路径，"
+            f"默认已跳过 {', '.join(DEFAULT_EXCLUDES)}",
+        )
+        sub.add_argument(
+            "-v",
+            "--verbose",
+            action="store_true",
+            help="逐个输出处理的文件，默认只显示一行进度",
+        )
+        sub.add_argument(
+            "--log-file",
+            nargs="?",
+            const="",
+            default=None,
+            metavar="PATH",
+            help="逐个文件的详细信息写入该文件，不指定路径时写入脚本所在的 logs 目录",
+        )
+        sub.add_argument(
+            "--report",
+            metavar="PATH",
+            help="保存运行报告，扩展名为 .csv 时每行一个文件，否则为 JSON",
+        )
+        sub.add_argument(
+            "--slowest",
+            type=int,
+            default=10,
+            metavar="N",
+            help="报告中列出最慢的 N 个文件（默认 10）",
+        )
+        sub.add_argument(
+            "--profile",
+            metavar="PATH",
+            help="用 cProfile 分析主进程并保存结果，可用 pstats 或 snakeviz 查看",
+        )
+        sub.add_argument(
+            "--trace-memory",
+            action="store_true",
+            help="用 tracemalloc 跟踪主进程的内存分配",
+        )
+
+    def add_convert_options(sub):
+        sub.add_argument(
+            "-q",
+            "--quality",
+            type=int,
+            default=DEFAULT_QUALITY,
+            help=f"有损压缩质量(1-100，默认{DEFAULT_QUALITY})",
+        )
+        sub.add_argument("--lossless", action="store_true", help="使用无损压缩")
+        sub.add_argument(
+            "--auto",
+            dest="auto_classify",
+            action="store_true",
+            help="按图片内容自动选择无损、近无损或有损（需要 numpy）",
+        )
+        sub.add_argument(
+            "--metadata",
+            choices=METADATA_POLICIES,
+            default="strip",
+            help="元数据处理方式：strip 全部去除（默认）、icc 只保留色彩配置、all 全部保留；"
+            "EXIF 方向总是先应用到像素上",
+        )
+        sub.add_argument(
+            "--overwrite",
+            choices=["always", "never"],
+            default="never",
+            help="已存在的webp文件如何处理（默认 never）",
+        )
+        sub.add_argument(
+            "--max-dimension",
+            type=int,
+            default=None,
+            metavar="PX",
+            help="输出图片的最长边，超过时等比缩小（JPEG 会直接缩小解码）",
+        )
+        target_group = sub.add_mutually_exclusive_group()
+        target_group.add_argument(
+            "--target-size",
+            type=int,
+            default=None,
+            metavar="KB",
+            help="逐张搜索质量，使webp不超过该大小",
+        )
+        target_group.add_argument(
+            "--target-ratio",
+            type=float,
+            default=None,
+            metavar="RATIO",
+            help="逐张搜索质量，使webp不超过原图大小的该比例（如 0.5）",
+        )
+        target_group.add_argument(
+            "--target-similarity",
+            type=float,
+            default=None,
+            metavar="SSIM",
+            help="逐张搜索满足该相似度（0-1，如 0.95）的最低质量，需要 numpy",
+        )
+        sub.add_argument(
+            "--widths",
+            type=parse_widths,
+            default=None,
+            metavar="W1,W2,...",
+            help="额外生成的响应式宽度，如 480,960,1600，输出为 name-480w.webp",
+        )
+        sub.add_argument(
+            "--formats",
+            type=parse_formats,
+            default=None,
+            metavar="F1,F2,...",
+            help=f"多格式转换：同一次解码编码出这些格式（{', '.join(OUTPUT_FORMATS)}），"
+            "Markdown 引用指向最小的结果",
+        )
+        sub.add_argument(
+            "--keep",
+            choices=KEEP_POLICIES,
+            default="smallest",
+            help="多格式转换时只保留最小的结果（默认），或全部保留供 <picture> 使用",
+        )
+        sub.add_argument(
+            "--avif-quality",
+            type=int,
+            default=None,
+            metavar="Q",
+            help=f"avif 的压缩质量（1-100），默认为 webp 质量减 {AVIF_QUALITY_OFFSET}，两者画质大致相当；"
+            f"--lossless 时为 {DEFAULT_QUALITY - AVIF_QUALITY_OFFSET}",
+        )
+        sub.add_argument(
+            "--memory-budget",
+            type=int,
+            default=None,
+            metavar="MB",
+            help="同时解码的图片估算内存上限，超出时推迟提交新任务",
+        )
+        sub.add_argument(
+            "--streaming",
+            action="store_true",
+            help="使用流式流水线，读取、编码、写入重叠进行，并显示各阶段队列深度",
+        )
+        sub.add_argument(
+            "--queue-size",
+            type=int,
+            default=DEFAULT_QUEUE_SIZE,
+            help=f"流式流水线中阶段之间的队列长度（默认 {DEFAULT_QUEUE_SIZE}）",
+        )
+        sub.add_argument(
+            "--no-cache",
+            dest="use_cache",
+            action="store_false",
+            help="不使用编码缓存",
+        )
+        sub.add_argument(
+            "--cache-dir",
+            default=None,
+            help=f"编码缓存目录（默认 {EncodeCache.default_dir()}）",
+        )
+        sub.add_argument(
+            "--cache-size",
+            type=int,
+            default=DEFAULT_CACHE_SIZE_MB,
+            metavar="MB",
+            help=f"编码缓存容量上限（默认 {DEFAULT_CACHE_SIZE_MB} MB）",
+        )
+        sub.add_argument(
+            "--no-dedup",
+            dest="deduplicate",
+            action="store_false",
+            help="不合并内容相同的图片，每张都单独编码",
+        )
+        sub.add_argument(
+            "--full",
+            dest="incremental",
+            action="store_false",
+            help="忽略转换记录，重新转换所有图片",
+        )
+
+    def add_rewrite_options(sub):
+        sub.add_argument(
+            "--no-direct",
+            dest="replace_direct",
+            action="store_false",
+            help="不替换直接引用和Imgrow中的图片文件名",
+        )
+        sub.add_argument(
+            "--srcset",
+            action="store_true",
+            help="为 <img> 和具名参数的 shortcode 补充已生成的响应式图片 srcset",
+        )
+
+    def add_resume_option(sub):
+        sub.add_argument(
+            "--resume",
+            action="store_true",
+            help="从上次被中断的运行继续：沿用当时的备份，跳过已完成的文件",
+        )
+
+    convert_parser = subparsers.add_parser("convert", help="转换图片为 Webp 格式")
+    add_common(convert_parser)
+    add_convert_options(convert_parser)
+    add_resume_option(convert_parser)
+
+    rewrite_parser = subparsers.add_parser(
+        "rewrite-references", help="更新 Markdown 中的图片引用"
+    )
+    add_common(rewrite_parser)
+    add_rewrite_options(rewrite_parser)
+    add_resume_option(rewrite_parser)
+
+    pipeline_parser = subparsers.add_parser(
+        "pipeline", help="执行完整流程（转换 + 更新引用）"
+    )
+    add_common(pipeline_parser)
+    add_convert_options(pipeline_parser)
+    add_rewrite_options(pipeline_parser)
+    add_resume_option(pipeline_parser)
+
+    delete_parser = subparsers.add_parser(
+        "delete-originals", help="删除已转换图片的原始文件"
+    )
+    add_common(delete_parser)
+    delete_parser.add_argument(
+        "--force",
+        action="store_true",
+        help="仍被Markdown引用的原图也删除",
+    )
+    delete_parser.add_argument(
+        "--max-diff",
+        type=float,
+        default=None,
+        metavar="DIFF",
+        help="删除前逐张与原图比较像素，平均差异（0-255）超过该值时不删除（需要 numpy）",
+    )
+
+    orphans_parser = subparsers.add_parser(
+        "orphans", help="列出没有被任何Markdown引用的图片和webp"
+    )
+    add_common(orphans_parser)
+
+    watch_parser = subparsers.add_parser(
+        "watch", help="持续监视目录，自动转换新增或修改的图片并更新引用"
+    )
+    add_common(watch_parser)
+    add_convert_options(watch_parser)
+    add_rewrite_options(watch_parser)
+    watch_parser.add_argument(
+        "--debounce",
+        type=int,
+        default=200,
+        metavar="MS",
+        help="最后一次变化后等待的毫秒数，期间的变化合并处理（默认 200）",
+    )
+    watch_parser.add_argument(
+        "--poll", action="store_true", help="不使用 inotify，改为定期对比文件状态"
+    )
+    watch_parser.add_argument(
+        "--interval",
+        type=float,
+        default=0.5,
+        help="轮询间隔秒数（默认 0.5）",
+    )
+
+    cache_parser = subparsers.add_parser("cache-stats", help="查看编码缓存统计")
+    cache_parser.add_argument("--cache-dir", default=None, help="编码缓存目录")
+    cache_parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=None,
+        metavar="MB",
+        help="同时按该容量上限淘汰最久未使用的条目",
+    )
+
+    restore_parser = subparsers.add_parser("restore", help="从备份快照恢复文件")
+    restore_parser.add_argument("snapshot", help="快照文件夹路径")
+    restore_parser.add_argument(
+        "--to", default=None, help="恢复到的文件夹（默认为原始文件夹）"
+    )
+    return parser
+
+
+def run_cli(argv):
+    """非交互的命令行入口
+    Returns:
+        exit_code: 进程退出码
+    """
+    args = build_parser().parse_args(argv)
+    if args.command == "restore":
+        return 0 if restore_snapshot(args.snapshot, args.to) is not None else 1
+    if args.command == "cache-stats":
+        show_cache_stats(EncodeCache(args.cache_dir), args.cache_size)
+        return 0
+
+    folder_path = args.folder
+    if not os.path.isdir(folder_path):
+        print(f"{Fore.RED}输入的文件夹路径不存在！{Style.RESET_ALL}")
+        return 2
+    if args.log_file == "":
+        # 整个运行（监视时为整个监视过程）共用一个日志文件
+        args.log_file = default_log_path("watch" if args.command == "watch" else "run")
+
+    if (
+        not 1 <= getattr(args, "quality", 80) <= 100
+        or not 1 <= (getattr(args, "avif_quality", None) or 80) <= 100
+    ):
+        print(f"{Fore.RED}压缩质量必须在 1-100 之间{Style.RESET_ALL}")
+        return 2
+    if (
+        getattr(args, "target_similarity", None)
+        or getattr(args, "auto_classify", False)
+        or getattr(args, "max_diff", None) is not None
+    ) and np is None:
+        print(
+            f"{Fore.RED}按相似度搜索质量、自动判断和按像素差异校验需要先安装 numpy{Style.RESET_ALL}"
+        )
+        return 2
+
+    if "avif" in (getattr(args, "formats", None) or ()) and not features.check("avif"):
+        print(f"{Fore.RED}当前 Pillow 不支持 AVIF 编码，请升级 Pillow{Style.RESET_ALL}")
+        return 2
+
+    report = RunReport(args.command)
+    profiler = cProfile.Profile() if args.profile else None
+    if args.trace_memory:
+        tracemalloc.start(25)
+    if profiler:
+        profiler.enable()
+    try:
+        exit_code = _run_command(args, folder_path, report)
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+            print(f"\n性能分析结果已保存到 {args.profile}（只包含主进程）")
+            pstats.Stats(profiler).sort_stats("cumulative").print_stats(20)
+        if args.trace_memory:
+            show_memory_trace()
+
+    report.print_summary(args.slowest)
+    if args.report:
+        report.save(args.report, args.slowest)
+        print(f"\n运行报告已保存到 {args.report}")
+    return exit_code
+
+
+def show_memory_trace(limit=10):
+    """显示 tracemalloc 记录的峰值内存和分配最多的代码位置"""
+    current, peak = tracemalloc.get_traced_memory()
+    snapshot = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    print(
+        f"\n{Fore.CYAN}内存跟踪（只包含主进程）：当前 {current / 1024 / 1024:.1f} MB，"
+        f"峰值 {peak / 1024 / 1024:.1f} MB{Style.RESET_ALL}"
+    )
+    for stat in snapshot.statistics("lineno")[:limit]:
+        print(f"  {stat}")
+
+
+def resume_run(journal, scan):
+    """继续中断的运行：追加写入运行日志，并清理中断时留下的临时文件"""
+    journal.resume()
+    print(f"\n继续 {journal.run['created']} 开始的运行")
+    if journal.run["backup"]:
+        print(f"沿用中断前的备份: {journal.run['backup']}")
+    removed_count = remove_stale_temp_files(
+        os.path.dirname(path) for path in scan.images + scan.markdown
+    )
+    if removed_count:
+        print(f"已清理中断时留下的 {removed_count} 个临时文件")
+
+
+def _run_command(args, folder_path, report):
+    """执行 convert、rewrite-references、pipeline、delete-originals 命令
+    Returns:
+        exit_code: 进程退出码
+    """
+    exit_code = 0
+    with report.stage("discovery"):
+        scan = SiteScan(
+            folder_path,
+            include=args.include,
+            exclude=DEFAULT_EXCLUDES + tuple(args.exclude),
+        )
+        webp_index = WebpIndex(folder_path, scan=scan)
+
+    journal = None
+    resuming = False
+    if args.command in RESUMABLE_COMMANDS:
+        journal = RunJournal(folder_path)
+        resuming = args.resume and journal.can_resume(args.command)
+        if args.resume and not resuming:
+            print(
+                f"{Fore.YELLOW}没有找到中断的 {args.command} 运行，将从头开始{Style.RESET_ALL}"
+            )
+        elif not args.resume and journal.can_resume(args.command):
+            print(
+                f"{Fore.YELLOW}{journal.run['created']} 开始的运行没有完成，"
+                f"本次从头开始（加 --resume 可从中断处继续）{Style.RESET_ALL}"
+            )
+
+    backup_path = None
+    if resuming:
+        resume_run(journal, scan)
+    # 删除操作自带针对被删文件的备份，不需要整个目录的备份
+    elif args.backup and args.command not in ("delete-originals", "orphans"):
+        with report.stage("backup"):
+            backup_path = create_backup(folder_path, scan)
+            if not backup_path:
+                return 1
+    if journal and not resuming:
+        journal.start(args.command, backup_path)
+
+    try:
+        if args.command in ["convert", "pipeline"]:
+            stats = convert_images(
+                folder_path,
+                incremental=args.incremental,
+                webp_index=webp_index,
+                scan=scan,
+                report=report,
+                verbose=args.verbose,
+                log_path=args.log_file,
+                journal=journal,
+                **convert_options_from_args(args),
+            )
+            if stats["errors"]:
+                exit_code = 1
+
+        if args.command in ["rewrite-references", "pipeline"]:
+            rewrite_references(
+                folder_path,
+                need_confirm=False,
+                replace_direct=args.replace_direct,
+                webp_index=webp_index,
+                workers=args.workers,
+                scan=scan,
+                srcset=args.srcset,
+                report=report,
+                verbose=args.verbose,
+                log_path=args.log_file,
+                journal=journal,
+            )
+
+        if args.command == "orphans":
+            reference_index = ReferenceIndex(folder_path, webp_index.static_roots)
+            with report.stage("markdown_scan"):
+                reference_index.update(scan.markdown, scan.stat)
+            reference_index.save()
+            show_orphans(reference_index.orphans(scan.images + scan.webp), scan.stat)
+
+        if args.command == "watch":
+            watch_site(
+                folder_path,
+                convert_options_from_args(args),
+                replace_direct=args.replace_direct,
+                srcset=args.srcset,
+                include=args.include,
+                exclude=DEFAULT_EXCLUDES + tuple(args.exclude),
+                webp_index=webp_index,
+                scan=scan,
+                debounce=args.debounce / 1000,
+                poll=args.poll,
+                interval=args.interval,
+                verbose=args.verbose,
+                log_path=args.log_file,
+            )
+
+        if args.command == "delete-originals":
+            with report.stage("delete"):
+                deleted_count = delete_original_images(
+                    folder_path,
+                    backup=args.backup,
+                    webp_index=webp_index,
+                    scan=scan,
+                    verbose=args.verbose,
+                    log_path=args.log_file,
+                    allow_referenced=args.force,
+                    workers=args.workers,
+                    max_diff=args.max_diff,
+                )
+            print(f"\n删除完成！共删除 {deleted_count} 个原始图片文件")
+    except BaseException:
+        # 保留运行日志，下次可以用 --resume 继续
+        if journal:
+            journal.close()
+        raise
+    if journal:
+        journal.finish()
+    return exit_code
 
 
 def main():
+    if len(sys.argv) > 1:
+        sys.exit(run_cli(sys.argv[1:]))
+
     show_introduction()
 
     while True:
@@ -764,9 +4925,32 @@ def main():
             print(f"{Fore.RED}输入的文件夹路径不存在！{Style.RESET_ALL}")
             continue
 
+        # 只遍历一次目录，备份、转换、更新引用和删除共用扫描结果和webp索引
+        scan = SiteScan(folder_path)
+        webp_index = WebpIndex(folder_path, scan=scan)
+
+        command = {"1": "convert", "2": "rewrite-references", "3": "pipeline"}.get(
+            choice
+        )
+        journal = RunJournal(folder_path) if command else None
+        resuming = (
+            journal is not None
+            and journal.can_resume(command)
+            and input(
+                f"\n发现 {journal.run['created']} 开始、没有完成的运行，"
+                "是否从中断处继续？(y/n，默认y): "
+            )
+            .strip()
+            .lower()
+            != "n"
+        )
+
+        backup_path = None
+        if resuming:
+            resume_run(journal, scan)
         # 一定要备份啊 T-T
-        if show_warning():
-            backup_path = create_backup(folder_path)
+        elif show_warning():
+            backup_path = create_backup(folder_path, scan)
             if not backup_path:
                 continue
         else:
@@ -776,23 +4960,37 @@ def main():
             if input("确定要继续吗？(y/n): ").strip().lower() != "y":
                 continue
 
-        if choice in ["1", "3"]:
-            process_images(folder_path)
+        if journal and not resuming:
+            journal.start(command, backup_path)
+        try:
+            if choice in ["1", "3"]:
+                process_images(folder_path, webp_index, scan, journal)
 
-        if choice in ["2", "3"]:
-            process_markdown(folder_path)
+            if choice in ["2", "3"]:
+                process_markdown(folder_path, webp_index, scan, journal)
+        except BaseException:
+            # 保留运行日志，下次选择同一功能时可以继续
+            if journal:
+                journal.close()
+            raise
+        if journal:
+            journal.finish()
 
         if choice == "4":
             print(f"\n{Fore.YELLOW}删除说明：{Style.RESET_ALL}")
             print(
-                "1. 脚本会在指定文件夹中搜索所有图片文件（jpg、png、jpeg、bmp、tiff）"
+                "1. 脚本会在指定文件夹中搜索所有图片文件（jpg、png、jpeg、bmp、tiff、gif）"
             )
             print("2. 检查每个图片是否存在同名的 webp 文件")
             print("   例如：对于 image.jpg，检查是否存在 image.webp")
             print(
                 "3. 如果找到同名的 webp 文件，则将原始图片（如 image.jpg）加入删除列表"
             )
-            print("4. 删除操作不可逆，建议先进行备份")
+            print(
+                "4. 删除前会并行校验每个 webp 是否完整、能否解码、尺寸是否与原图一致，"
+            )
+            print("   未通过校验的原图不会删除")
+            print("5. 删除操作不可逆，建议先进行备份")
 
             if (
                 input(f"\n{Fore.RED}您确定要继续删除操作吗？(y/n): {Style.RESET_ALL}")
@@ -800,7 +4998,9 @@ def main():
                 .lower()
                 == "y"
             ):
-                deleted_count = delete_original_images(folder_path)
+                deleted_count = delete_original_images(
+                    folder_path, webp_index=webp_index, scan=scan
+                )
                 print(f"\n删除完成！共删除 {deleted_count} 个原始图片文件")
             else:
                 print("操作已取消")